@@ -0,0 +1,534 @@
+"""Offline throughput benchmark for FileSave.
+
+Runs the plugin against local stand-ins instead of a live guild: an aiohttp server serving synthetic attachments in place
+of Discord's CDN, archive channels whose `send` follows a rate limit bucket, and an in-memory Mongo.
+
+Run it from the root of a Modmail checkout (so `bot` and `core` can be imported), e.g.:
+    python plugins/.../filesave/benchmark.py --messages 200 --attachments 4 --size 2MB --mode both
+"""
+
+import argparse
+import asyncio
+import collections
+import copy
+import itertools
+import os
+import random
+import resource
+import socket
+import statistics
+import sys
+import time
+import types
+
+import aiohttp
+from aiohttp import web
+
+sys.path.insert(0, os.getcwd())
+
+import filesave  # noqa: E402
+
+THREAD_ID = 1_100_000_000_000_000_000
+ARCHIVE_ID = 1_200_000_000_000_000_000
+LOG_ID = 1_300_000_000_000_000_000
+BOT_ID = 1_400_000_000_000_000_000
+USER_ID = 1_500_000_000_000_000_000
+
+snowflakes = itertools.count(THREAD_ID + 1)
+
+
+def parse_size(text: str):
+	units = {"kb": 1024, "mb": 1024**2, "gb": 1024**3, "b": 1}
+	for unit, factor in units.items():
+		if text.lower().endswith(unit):
+			return int(float(text[: -len(unit)]) * factor)
+	return int(text)
+
+
+def percentile(values: list, q: float):
+	if not values:
+		return 0.0
+	values = sorted(values)
+	return values[min(int(q * len(values)), len(values) - 1)]
+
+
+# Mongo
+
+
+def matches(doc: dict, query: dict):
+	for key, cond in query.items():
+		if key == "$or":
+			if not any(matches(doc, q) for q in cond):
+				return False
+			continue
+		value = doc.get(key)
+		if isinstance(cond, dict) and any(k.startswith("$") for k in cond):
+			for op, arg in cond.items():
+				if op == "$ne" and value == arg:
+					return False
+				elif op == "$in" and value not in arg:
+					return False
+				elif op in ("$lt", "$lte", "$gt", "$gte"):
+					if value is None:
+						return False
+					if op == "$lt" and not value < arg:
+						return False
+					if op == "$lte" and not value <= arg:
+						return False
+					if op == "$gt" and not value > arg:
+						return False
+					if op == "$gte" and not value >= arg:
+						return False
+		elif value != cond:
+			return False
+	return True
+
+
+def apply_update(doc: dict, update: dict, inserting: bool):
+	for key, value in update.get("$set", {}).items():
+		if "$[" not in key:
+			doc[key] = value
+	if inserting:
+		doc.update(update.get("$setOnInsert", {}))
+	for key, value in update.get("$inc", {}).items():
+		doc[key] = doc.get(key, 0) + value
+	for key in update.get("$unset", {}):
+		doc.pop(key, None)
+
+
+class FakeResult:
+	def __init__(self, deleted_count: int = 0):
+		self.deleted_count = deleted_count
+
+
+class FakeCursor:
+	def __init__(self, docs: list):
+		self.docs = docs
+
+	def sort(self, key, direction=None):
+		keys = key if isinstance(key, list) else [(key, direction or 1)]
+		for field, order in reversed(keys):
+			self.docs.sort(key=lambda d: d.get(field), reverse=order == -1)
+		return self
+
+	def limit(self, count: int):
+		if count:
+			self.docs = self.docs[:count]
+		return self
+
+	def batch_size(self, size: int):
+		return self
+
+	async def to_list(self, length=None):
+		return self.docs[:length] if length else self.docs
+
+	def __aiter__(self):
+		return self._iter()
+
+	async def _iter(self):
+		for doc in self.docs:
+			yield doc
+
+
+class FakeCollection:
+	"""The part of a motor collection FileSave uses, kept in a dict. Updates on array elements are counted, not applied."""
+
+	def __init__(self, database, name: str):
+		self.database = database
+		self.name = name
+		self.docs = {}
+		self.ids = itertools.count(1)
+		self.calls = 0
+
+	def __getitem__(self, name: str):
+		return self.database[f"{self.name}.{name}"]
+
+	async def create_index(self, *args, **kwargs):
+		return "index"
+
+	def _matching(self, query: dict):
+		return [doc for doc in self.docs.values() if matches(doc, query or {})]
+
+	async def find_one(self, query: dict = None, *args, **kwargs):
+		self.calls += 1
+		found = self._matching(query)
+		return copy.deepcopy(found[0]) if found else None
+
+	def find(self, query: dict = None, *args, **kwargs):
+		self.calls += 1
+		return FakeCursor(copy.deepcopy(self._matching(query)))
+
+	async def insert_one(self, doc: dict):
+		self.calls += 1
+		doc = copy.deepcopy(doc)
+		doc.setdefault("_id", next(self.ids))
+		self.docs[doc["_id"]] = doc
+
+	async def update_one(self, query: dict, update: dict, upsert: bool = False, array_filters=None):
+		self.calls += 1
+		found = self._matching(query)
+		if found:
+			apply_update(found[0], update, False)
+		elif upsert:
+			doc = {k: v for k, v in query.items() if not isinstance(v, dict) and not k.startswith("$")}
+			doc.setdefault("_id", next(self.ids))
+			apply_update(doc, update, True)
+			self.docs[doc["_id"]] = doc
+
+	async def update_many(self, query: dict, update: dict):
+		self.calls += 1
+		for doc in self._matching(query):
+			apply_update(doc, update, False)
+
+	async def find_one_and_update(self, query: dict, update: dict, upsert=False, sort=None, return_document=False):
+		found = FakeCursor(self._matching(query))
+		if sort:
+			found.sort(sort)
+		if not found.docs:
+			await self.update_one(query, update, upsert=upsert)
+			return None
+		self.calls += 1
+		before = copy.deepcopy(found.docs[0])
+		apply_update(found.docs[0], update, False)
+		return copy.deepcopy(found.docs[0]) if return_document else before
+
+	async def delete_one(self, query: dict):
+		self.calls += 1
+		found = self._matching(query)
+		if found:
+			del self.docs[found[0]["_id"]]
+		return FakeResult(len(found[:1]))
+
+	async def count_documents(self, query: dict):
+		self.calls += 1
+		return len(self._matching(query))
+
+	async def bulk_write(self, requests: list, ordered: bool = True):
+		self.calls += 1
+		for request in requests:
+			found = self._matching(request._filter)
+			if found:
+				apply_update(found[0], request._doc, False)
+			elif request._upsert:
+				doc = {k: v for k, v in request._filter.items() if not isinstance(v, dict)}
+				apply_update(doc, request._doc, True)
+				self.docs[doc["_id"]] = doc
+
+
+class FakeDatabase(dict):
+	def __missing__(self, name: str):
+		self[name] = FakeCollection(self, name)
+		return self[name]
+
+
+# Discord
+
+
+class FakeGuild:
+	def __init__(self, filesize_limit: int):
+		self.filesize_limit = filesize_limit
+		self.me = None
+
+
+class FakeAttachment:
+	def __init__(self, base_url: str, size: int, content_type: str):
+		self.id = next(snowflakes)
+		self.size = size
+		self.content_type = content_type
+		self.filename = f"{self.id}.{'png' if content_type.startswith('image') else 'bin'}"
+		self.url = f"{base_url}/attachments/{THREAD_ID}/{self.id}/{size}/{self.filename}"
+
+
+class FakeMessage:
+	def __init__(self, channel, content: str = "", attachments: list = None, author_id: int = USER_ID):
+		self.id = next(snowflakes)
+		self.channel = channel
+		self.content = content
+		self.attachments = attachments or []
+		self.author = types.SimpleNamespace(id=author_id)
+
+	async def edit(self, content: str = None, **kwargs):
+		self.content = content
+
+
+class FakeChannel:
+	"""A text channel whose `send` waits like discord.py does when the channel's rate limit bucket is empty."""
+
+	def __init__(self, channel_id: int, guild: FakeGuild, bucket: int, period: float, latency: float, bandwidth: float):
+		self.id = channel_id
+		self.guild = guild
+		self.bucket = bucket
+		self.period = period
+		self.latency = latency
+		self.bandwidth = bandwidth
+		self.sent = collections.deque()
+		self.rate_limited = 0
+		self.uploaded = 0
+		self.last_message_id = None
+
+	async def send(self, content: str = None, *, file=None, files=None, embed=None, **kwargs):
+		now = time.monotonic()
+		while self.sent and now - self.sent[0] >= self.period:
+			self.sent.popleft()
+		if len(self.sent) >= self.bucket:
+			self.rate_limited += 1
+			await asyncio.sleep(self.period - (now - self.sent[0]))
+		self.sent.append(time.monotonic())
+
+		files = files or ([file] if file else [])
+		size = 0
+		for f in files:
+			size += len(f.fp.read())
+			f.close()
+		self.uploaded += size
+		await asyncio.sleep(self.latency + (size / self.bandwidth if self.bandwidth else 0))
+
+		msg = FakeMessage(self, content or "", author_id=BOT_ID)
+		msg.attachments = [
+			types.SimpleNamespace(
+				id=next(snowflakes), filename=f.filename, url=f"https://archive.invalid/{self.id}/{f.filename}"
+			)
+			for f in files
+		]
+		return msg
+
+
+class FakeThread(FakeChannel):
+	def __init__(self, guild: FakeGuild):
+		super().__init__(THREAD_ID, guild, 10**9, 1, 0, 0)
+		self.messages = []
+
+	async def history(self, limit=100, oldest_first=None, after=None, before=None):
+		messages = self.messages if oldest_first else list(reversed(self.messages))
+		count = 0
+		for msg in messages:
+			if after and msg.id <= after.id or before and msg.id >= before.id:
+				continue
+			if limit is not None and count >= limit:
+				return
+			count += 1
+			yield msg
+
+
+class FakeContext:
+	def __init__(self, channel: FakeThread):
+		self.channel = channel
+		self.guild = channel.guild
+		self.message = FakeMessage(channel, "?filesave archivethread")
+
+	async def send(self, content: str = None, **kwargs):
+		return FakeMessage(self.channel, content or "", author_id=BOT_ID)
+
+
+class FakeBot:
+	def __init__(self, session: aiohttp.ClientSession, channels: dict, thread: FakeThread):
+		self.session = session
+		self.db = FakeDatabase()
+		self.channels = channels
+		self.log_channel = channels[LOG_ID]
+		self.user = types.SimpleNamespace(id=BOT_ID)
+		self.main_color = self.error_color = 0
+		self.api = types.SimpleNamespace(get_plugin_partition=lambda cog: self.db[f"plugins.{type(cog).__name__}"])
+		self.threads = types.SimpleNamespace(
+			cache={USER_ID: types.SimpleNamespace(channel=thread)}, populate_cache=self.populate_cache
+		)
+
+	async def wait_for_connected(self):
+		pass
+
+	async def populate_cache(self):
+		pass
+
+	def get_channel(self, channel_id: int):
+		return self.channels.get(channel_id)
+
+	async def add_reaction(self, message, emoji):
+		pass
+
+
+# CDN
+
+
+def cdn_app(latency: float):
+	block = random.randbytes(1024 * 1024)
+
+	async def serve(request: web.Request):
+		await asyncio.sleep(latency)
+		size = int(request.match_info["size"])
+		resp = web.StreamResponse(headers={"Content-Length": str(size)})
+		await resp.prepare(request)
+		# The attachment ID goes first so every attachment hashes differently.
+		prefix = request.match_info["id"].encode()[:size]
+		await resp.write(prefix)
+		sent = len(prefix)
+		while sent < size:
+			chunk = block[: min(filesave.CHUNK_SIZE, size - sent)]
+			await resp.write(chunk)
+			sent += len(chunk)
+		await resp.write_eof()
+		return resp
+
+	app = web.Application()
+	app.router.add_get("/attachments/{channel}/{id}/{size}/{filename}", serve)
+	return app
+
+
+# Runs
+
+
+class TimedFileSave(filesave.FileSave):
+	"""Records how long each job took from the message being sent to it being archived, and which jobs failed."""
+
+	def __init__(self, bot):
+		super().__init__(bot)
+		self.sent_at = {}
+		self.latencies = []
+		self.failed = set()
+		self.finished = asyncio.Event()
+		self.expected = 0
+
+	async def run_job(self, job: dict):
+		await super().run_job(job)
+		# `run_job` doesn't raise when a job fails, it leaves it in the queue to be retried or given up on.
+		if job["_id"] in self.jobs.docs:
+			self.failed.add(job["message_id"])
+		else:
+			self.failed.discard(job["message_id"])
+			self.latencies.append(time.monotonic() - self.sent_at[job["message_id"]])
+		if len(self.latencies) + len(self.failed) >= self.expected:
+			self.finished.set()
+
+
+def make_messages(args, base_url: str, channel):
+	messages = []
+	for _ in range(args.messages):
+		attachments = [
+			FakeAttachment(base_url, parse_size(args.size), "image/png" if random.random() < args.images else "application/octet-stream")
+			for _ in range(args.attachments)
+		]
+		messages.append(FakeMessage(channel, attachments=attachments))
+	return messages
+
+
+async def run_live(cog: TimedFileSave, messages: list, interval: float):
+	cog.expected = len(messages)
+	cog.failed.clear()
+	cog.finished.clear()
+	started = time.monotonic()
+	for msg in messages:
+		cog.sent_at[msg.id] = time.monotonic()
+		await cog.on_message(msg)
+		if interval:
+			await asyncio.sleep(interval)
+	await cog.finished.wait()
+	return time.monotonic() - started, cog.latencies, len(cog.failed)
+
+
+async def run_archive(cog: TimedFileSave, thread: FakeThread, messages: list):
+	thread.messages = messages
+	thread.last_message_id = messages[-1].id
+	latencies = []
+	failed = 0
+	original = cog.save_file
+
+	async def save_file(*args, **kwargs):
+		nonlocal failed
+		started = time.monotonic()
+		try:
+			result = await original(*args, **kwargs)
+		except Exception:
+			failed += 1
+			raise
+		if result:
+			failed += 1
+		else:
+			latencies.append(time.monotonic() - started)
+		return result
+
+	cog.save_file = save_file
+	flags = types.SimpleNamespace(limit=None, oldest=True, before=None, after=None, fresh=True)
+	started = time.monotonic()
+	await filesave.FileSave.archivethread.callback(cog, FakeContext(thread), flags=flags)
+	elapsed = time.monotonic() - started
+	cog.save_file = original
+	return elapsed, latencies, failed
+
+
+def report(name: str, messages: int, elapsed: float, latencies: list, failed: int, leftover: int, channels: list):
+	print(f"{name}:")
+	if failed or leftover:
+		print(f"  WARNING: {failed} messages failed and {leftover} jobs are left in the queue, so these numbers are not valid")
+	archived = messages - failed
+	print(f"  {archived}/{messages} messages archived in {elapsed:.2f}s ({archived / elapsed:.1f} messages/s)")
+	print(f"  latency p50 {percentile(latencies, 0.5):.3f}s, p99 {percentile(latencies, 0.99):.3f}s", end="")
+	print(f", mean {statistics.fmean(latencies):.3f}s" if latencies else "")
+	print(f"  uploaded {sum(c.uploaded for c in channels) / 1024**2:.1f} MB, {sum(c.rate_limited for c in channels)} rate limit waits")
+
+
+async def main(args):
+	random.seed(args.seed)
+	sock = socket.socket()
+	sock.bind(("127.0.0.1", 0))
+	runner = web.AppRunner(cdn_app(args.cdn_latency / 1000))
+	await runner.setup()
+	await web.SockSite(runner, sock).start()
+	base_url = f"http://127.0.0.1:{sock.getsockname()[1]}"
+
+	guild = FakeGuild(parse_size(args.filesize_limit))
+	thread = FakeThread(guild)
+	channel_args = (args.bucket, args.period, args.latency / 1000, parse_size(args.bandwidth) if args.bandwidth else 0)
+	pool = [ARCHIVE_ID + i for i in range(max(args.channels, 1))]
+	channels = {channel_id: FakeChannel(channel_id, guild, *channel_args) for channel_id in pool}
+	channels[LOG_ID] = FakeChannel(LOG_ID, guild, *channel_args)
+	channels[THREAD_ID] = thread
+
+	async with aiohttp.ClientSession() as session:
+		bot = FakeBot(session, channels, thread)
+		cog = TimedFileSave(bot)
+		partition = bot.api.get_plugin_partition(cog)
+		config = {"_id": "filesave", "channels": pool}
+		for option in args.set:
+			key, _, value = option.partition("=")
+			config[key] = filesave.convert_option(key, value)
+		await partition.insert_one(config)
+		await cog.cog_load()
+		await cog.ready.wait()
+		archive = [c for c in channels.values() if c is not thread]
+
+		try:
+			if args.mode in ("live", "both"):
+				messages = make_messages(args, base_url, thread)
+				elapsed, latencies, failed = await run_live(cog, messages, args.interval / 1000)
+				report("on_message", len(messages), elapsed, latencies, failed, len(cog.jobs.docs), archive)
+			if args.mode in ("archive", "both"):
+				for c in archive:
+					c.uploaded = c.rate_limited = 0
+				messages = make_messages(args, base_url, thread)
+				elapsed, latencies, failed = await run_archive(cog, thread, messages)
+				report("archivethread", len(messages), elapsed, latencies, failed, len(cog.jobs.docs), archive)
+		finally:
+			await cog.cog_unload()
+			await runner.cleanup()
+
+	# ru_maxrss is in KB on Linux.
+	print(f"peak RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB")
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--mode", choices=("live", "archive", "both"), default="both")
+	parser.add_argument("--messages", type=int, default=100, help="messages per run")
+	parser.add_argument("--attachments", type=int, default=3, help="attachments per message")
+	parser.add_argument("--size", default="512KB", help="size of each attachment, e.g. 800KB or 8MB")
+	parser.add_argument("--images", type=float, default=0.5, help="fraction of attachments that are images")
+	parser.add_argument("--interval", type=float, default=0, help="ms between live messages")
+	parser.add_argument("--cdn-latency", type=float, default=20, help="ms before the CDN starts answering")
+	parser.add_argument("--latency", type=float, default=80, help="ms a channel send takes besides uploading")
+	parser.add_argument("--bandwidth", default="", help="upload bandwidth per send per second, e.g. 50MB")
+	parser.add_argument("--bucket", type=int, default=5, help="sends a channel allows per period")
+	parser.add_argument("--period", type=float, default=5, help="seconds a channel's bucket takes to refill")
+	parser.add_argument("--channels", type=int, default=1, help="archive channels in the pool")
+	parser.add_argument("--filesize-limit", default="25MB", help="the guild's upload limit")
+	parser.add_argument("--set", action="append", default=[], metavar="OPTION=VALUE", help="a FileSave setting")
+	parser.add_argument("--seed", type=int, default=0)
+	asyncio.run(main(parser.parse_args()))
@@ -1,17 +1,111 @@
+import collections
+import contextlib
+import datetime
+import hashlib
 import io
-from typing import Union
+import itertools
+import json
+import math
+import mimetypes
+import os
+import re
+import shutil
+import tempfile
+import time
+import urllib.parse
+import zipfile
+from typing import Dict, List, NamedTuple, Tuple, Union
 
-import aiofiles
 import asyncio
 import discord
 from discord import http
-from discord.ext import commands
+from discord.ext import commands, tasks
+from pymongo import UpdateOne
+from pymongo.errors import CursorNotFound
 
 from bot import ModmailBot, checks
+from core import models
 
+logger: models.ModmailLogger = models.getLogger(__name__)
 
-# Todo:
-# Maybe send multiple attachments per messsage...
+DEFAULT_CONFIG = {
+	"concurrency": 4,
+	"batch": True,
+	"spool_threshold": 8,
+	"workers": 2,
+	"max_attempts": 5,
+	"lease_timeout": 300,
+	"allow_types": [],
+	"deny_types": [],
+	"max_size": 0,
+	"oversize": "skip",
+	"upload_burst": 5,
+	"upload_period": 5,
+	"memory_budget": 256,
+	"metrics_file": "",
+	"backfill_rate": 120,
+	"pool_strategy": "load",
+	"bundle": False,
+	"bundle_threshold": 512,
+}
+
+# Values that text options are limited to.
+OPTION_CHOICES = {
+	"oversize": ("skip", "reference"),
+	"pool_strategy": ("hash", "load"),
+}
+
+# The lowest values number options can have, for the ones that can't be 0.
+OPTION_MINIMUMS = {
+	"spool_threshold": 1,
+	"lease_timeout": 30,
+}
+
+# How many bytes are read from a download at a time.
+CHUNK_SIZE = 64 * 1024
+
+# Discord's limit of attachments per message.
+MAX_FILES = 10
+
+# How long an idle worker waits before checking the job queue again, in seconds.
+POLL_INTERVAL = 10
+
+# How often archivethread updates its progress message and checkpoint, in seconds.
+PROGRESS_INTERVAL = 5
+
+# How many log urls a single update rewrites. Every array filter is checked against every attachment in the log.
+REWRITES_PER_UPDATE = 50
+
+# How many messages with attachments are held while the cog warms up. Past this, the oldest are dropped.
+PENDING_LIMIT = 1000
+
+# Matches a Discord attachment url, capturing the ID of the channel it was sent in and its own.
+ATTACHMENT_URL = re.compile(r"^https://(?:cdn|media)\.discordapp\.(?:com|net)/(?:ephemeral-)?attachments/(\d+)/(\d+)/")
+
+# How many logs backfill fetches from the database at a time. Kept small since the cursor expires if it sits idle.
+BACKFILL_BATCH = 20
+
+# Discord's limit of urls per request to refresh attachment urls.
+REFRESH_BATCH = 50
+
+# How long before a signed attachment url expires it's refreshed anyway, in seconds, since uploads can wait a while.
+REFRESH_MARGIN = 3600
+
+# How many files a bundle needs to be worth making. Fewer are sent as they are.
+BUNDLE_MIN = 2
+
+# Room left under the upload limit for a bundle's zip headers and manifest, in bytes.
+BUNDLE_HEADROOM = 1024 * 1024
+
+# How many files can go in one bundle.
+BUNDLE_FILES = 500
+
+# The name of the file in a bundle that lists what's in it.
+MANIFEST = "manifest.json"
+
+# Upload priorities. Lower goes first.
+LIVE = 0
+BULK = 1
 
 
 class ConfirmView(discord.ui.View):
@@ -46,113 +140,1276 @@ async def confirmation(ctx: discord.ext.commands.Context, message: str):
 	return view.value
 
 
+def convert_option(option: str, value: str):
+	"""Convert a config value given in a command to the type of its default.
+	:param option: The config option.
+	:param value: The value as it was typed.
+	:return: The converted value.
+	"""
+	default = DEFAULT_CONFIG[option]
+	if isinstance(default, bool):
+		if value.lower() in ("yes", "y", "true", "on", "1"):
+			return True
+		elif value.lower() in ("no", "n", "false", "off", "0"):
+			return False
+		raise ValueError(value)
+	elif isinstance(default, int):
+		value = int(value)
+		if value < OPTION_MINIMUMS.get(option, 0):
+			raise ValueError(value)
+		return value
+	elif isinstance(default, list):
+		if value.lower() in ("none", "clear"):
+			return []
+		return [v.lower() for v in value.replace(",", " ").split()]
+	elif option in OPTION_CHOICES:
+		if value.lower() not in OPTION_CHOICES[option]:
+			raise ValueError(value)
+		return value.lower()
+	elif value.lower() in ("none", "clear"):
+		return ""
+	elif option == "metrics_file" and not value.endswith(".prom"):
+		raise ValueError(value)
+	return value
+
+
+def mime_matches(content_type: str, pattern: str):
+	"""Check a MIME type against a pattern like `video/mp4`, `video/` or `video/*`."""
+	pattern = pattern.rstrip("*")
+	if pattern.endswith("/"):
+		return content_type.startswith(pattern)
+	return content_type == pattern
+
+
+def format_size(size: int):
+	"""Format a byte count for people."""
+	for unit in ("B", "KB", "MB"):
+		if size < 1024:
+			return f"{size:.0f} {unit}"
+		size /= 1024
+	return f"{size:.1f} GB"
+
+
+class JobAttachment(NamedTuple):
+	"""The parts of an attachment that an archive job keeps."""
+
+	id: int
+	url: str
+	filename: str
+	content_type: Union[str, None]
+	size: int
+
+	@classmethod
+	def from_attachment(cls, att: discord.Attachment):
+		return cls(att.id, att.url, att.filename, att.content_type, att.size)
+
+
+def log_attachments(log: dict, archived_in: set) -> List[Tuple[int, List[JobAttachment]]]:
+	"""Find the attachments of a log that were never archived.
+
+	An attachment counts as archived if its url is in one of the archive channels. Urls that aren't Discord's are left alone.
+	:param log: The log, with at least the `message_id` and `attachments` of its messages.
+	:param archived_in: The IDs of the archive channels.
+	:return: Tuples of a message ID and its attachments that still need archiving, for messages that have any.
+	"""
+	found = []
+	for message in log.get("messages") or []:
+		attachments = []
+		for att in message.get("attachments") or []:
+			url = att.get("url") or ""
+			if not (match := ATTACHMENT_URL.match(url)) or int(match[1]) in archived_in:
+				continue
+			filename = att.get("filename") or url.rsplit("/", 1)[-1].split("?")[0]
+			attachments.append(
+				JobAttachment(
+					int(att.get("id") or match[2]), url, filename, mimetypes.guess_type(filename)[0], att.get("size") or 0
+				)
+			)
+		if attachments:
+			found.append((int(message.get("message_id") or 0), attachments))
+	return found
+
+
+def index_channel(doc: dict) -> Union[int, None]:
+	"""Get the ID of the archive channel a file index entry points into, from its url for entries that don't keep it."""
+	if "channel" in doc:
+		return doc["channel"]
+	match = ATTACHMENT_URL.match(doc.get("url") or "")
+	return int(match[1]) if match else None
+
+
+def url_expired(url: str) -> bool:
+	"""Whether an attachment url can no longer be downloaded, or won't be for long.
+
+	Discord signs attachment urls with an `ex` parameter, the hex timestamp they expire at. Unsigned ones are refused.
+	"""
+	query = urllib.parse.parse_qs(urllib.parse.urlsplit(url or "").query)
+	try:
+		expires = int(query["ex"][0], 16)
+	except (KeyError, ValueError):
+		return True
+	return expires < time.time() + REFRESH_MARGIN
+
+
+def backoff(attempts: int):
+	"""How long to wait before retrying a job.
+	:param attempts: How many times the job has been tried.
+	:return: datetime.timedelta
+	"""
+	return datetime.timedelta(seconds=min(15 * 2 ** (attempts - 1), 3600))
+
+
+def history_eta(start: int, current: int, end: Union[int, None], elapsed: float):
+	"""Estimate how long is left going through a channel's history, assuming messages are spread evenly over time.
+	:param start: The ID of the first message gone through.
+	:param current: The ID of the last message gone through.
+	:param end: The ID where the history ends.
+	:param elapsed: The seconds it took from start to current.
+	:return: The seconds left, or None if it can't be estimated yet.
+	"""
+	if end is None:
+		return None
+	covered = abs(current - start)
+	total = abs(end - start)
+	if not covered or elapsed <= 0:
+		return None
+	return max(elapsed * (total - covered) / covered, 0)
+
+
+def batch_attachments(attachments: List[discord.Attachment], size_limit: int, count_limit: int = MAX_FILES):
+	"""Group attachments into as few messages as the count and size limits allow, keeping their order.
+	:param attachments: The attachments to group.
+	:param size_limit: The total size a message's attachments can have.
+	:param count_limit: How many attachments a message can have.
+	:return: list
+	"""
+	batches = []
+	batch = []
+	size = 0
+	for att in attachments:
+		if batch and (len(batch) == count_limit or size + att.size > size_limit):
+			batches.append(batch)
+			batch = []
+			size = 0
+		batch.append(att)
+		size += att.size
+	if batch:
+		batches.append(batch)
+	return batches
+
+
+def build_bundle(files: List[Tuple[JobAttachment, Tuple[io.IOBase, str], str]], spool: int):
+	"""Pack downloaded files into a zip, along with a manifest of what's in it. Meant to be run in a worker thread.
+	:param files: Tuples of an attachment, its file-like object and filename, and its key in the file index.
+	:param spool: How many bytes of the zip are kept in memory before it's moved to a temporary file.
+	:return: The zip, as a file-like object, and the name each attachment has in it by ID.
+	"""
+	buffer = tempfile.SpooledTemporaryFile(max_size=spool)
+	members = {}
+	manifest = []
+	try:
+		with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as bundle:
+			for att, (fp, filename), key in files:
+				name = filename
+				if name == MANIFEST or name in members.values():
+					name = f"{att.id}-{filename}"
+				members[att.id] = name
+				manifest.append(
+					{
+						"name": name,
+						"id": att.id,
+						"filename": att.filename,
+						"content_type": att.content_type,
+						"size": att.size,
+						"sha256": key.split(":")[1],
+						"url": att.url,
+					}
+				)
+				fp.seek(0)
+				with bundle.open(name, "w") as member:
+					shutil.copyfileobj(fp, member)
+			bundle.writestr(MANIFEST, json.dumps(manifest, indent=2))
+	except BaseException:
+		buffer.close()
+		raise
+	return buffer, members
+
+
+class Metrics:
+	"""Counters and latency histograms for the archive path."""
+
+	# Upper bounds of the latency histogram buckets, in seconds.
+	BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, math.inf)
+
+	# Counters, with the label they're split by, if any, and their description.
+	COUNTERS = {
+		"bytes_downloaded": (None, "Attachment bytes downloaded."),
+		"bytes_uploaded": (None, "Bytes uploaded to the archive channel."),
+		"files_archived": (None, "Attachments uploaded to the archive channel."),
+		"files_deduplicated": (None, "Attachments found in the file index instead of being uploaded."),
+		"files_rejected": (None, "Attachments the file policy didn't let through."),
+		"files_backfilled": (None, "Attachments of past logs that backfill archived."),
+		"files_bundled": (None, "Attachments uploaded inside a bundle."),
+		"files_expired": (None, "Attachments of past logs backfill skipped, since their urls couldn't be refreshed."),
+		"fallbacks": (None, "Times an archive channel was dropped from the pool."),
+		"failures": ("type", "Failed steps, by exception type."),
+	}
+
+	def __init__(self):
+		self.counters = collections.defaultdict(collections.Counter)
+		self.histograms = {}
+
+	def inc(self, name: str, label: str = "", value: int = 1):
+		self.counters[name][label] += value
+
+	def observe(self, stage: str, seconds: float):
+		if stage not in self.histograms:
+			self.histograms[stage] = {"buckets": [0] * len(self.BUCKETS), "sum": 0.0, "count": 0}
+		histogram = self.histograms[stage]
+		for i, bound in enumerate(self.BUCKETS):
+			if seconds <= bound:
+				histogram["buckets"][i] += 1
+				break
+		histogram["sum"] += seconds
+		histogram["count"] += 1
+
+	@contextlib.contextmanager
+	def timer(self, stage: str):
+		started = time.monotonic()
+		try:
+			yield
+		finally:
+			self.observe(stage, time.monotonic() - started)
+
+	def quantile(self, stage: str, q: float):
+		"""Estimate a latency quantile as the upper bound of the bucket it falls in."""
+		histogram = self.histograms[stage]
+		rank = q * histogram["count"]
+		seen = 0
+		for bound, count in zip(self.BUCKETS, histogram["buckets"]):
+			seen += count
+			if seen >= rank:
+				return bound
+		return math.inf
+
+	def prometheus(self):
+		"""Render the metrics in Prometheus' text format."""
+		lines = []
+		for name, (label, description) in self.COUNTERS.items():
+			lines += [f"# HELP filesave_{name}_total {description}", f"# TYPE filesave_{name}_total counter"]
+			values = self.counters.get(name) or {"": 0}
+			for label_value, value in values.items():
+				labels = f'{{{label}="{label_value}"}}' if label else ""
+				lines.append(f"filesave_{name}_total{labels} {value}")
+		lines += ["# HELP filesave_stage_seconds Latency of each archive step.", "# TYPE filesave_stage_seconds histogram"]
+		for stage, histogram in self.histograms.items():
+			cumulative = 0
+			for bound, count in zip(self.BUCKETS, histogram["buckets"]):
+				cumulative += count
+				le = "+Inf" if bound == math.inf else bound
+				lines.append(f'filesave_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+			lines.append(f'filesave_stage_seconds_sum{{stage="{stage}"}} {histogram["sum"]}')
+			lines.append(f'filesave_stage_seconds_count{{stage="{stage}"}} {histogram["count"]}')
+		return "\n".join(lines) + "\n"
+
+
+class RateWindow:
+	"""Models a rate limit of `capacity` requests in any `period` seconds.
+
+	Discord's buckets don't refill gradually, they reset once their window is over, so a bucket refilling at
+	`capacity / period` would let close to twice its capacity through in the first period. Keeping no more than
+	`capacity` requests in any window also keeps them within each of Discord's.
+	"""
+
+	def __init__(self, capacity: int, period: float):
+		self.sent = collections.deque()
+		self.configure(capacity, period)
+
+	def configure(self, capacity: int, period: float):
+		"""Change the limit, still counting the requests already made."""
+		self.capacity = max(capacity, 1)
+		self.period = max(period, 0.001)
+
+	async def acquire(self):
+		"""Wait until a request can be made and count it."""
+		while True:
+			now = time.monotonic()
+			while self.sent and now - self.sent[0] >= self.period:
+				self.sent.popleft()
+			if len(self.sent) < self.capacity:
+				break
+			await asyncio.sleep(self.period - (now - self.sent[0]))
+		self.sent.append(now)
+
+
+class ByteBudget:
+	"""An async semaphore counted in bytes, handed out first come first served.
+
+	A request bigger than the whole budget is treated as the whole budget, so it can still go through once nothing else
+	holds any.
+	"""
+
+	def __init__(self, capacity: int):
+		self.capacity = capacity
+		self.used = 0
+		self.waiters = collections.deque()
+		self.waits = 0
+		self.wait_time = 0.0
+		self.max_wait = 0.0
+
+	async def acquire(self, size: int) -> int:
+		"""Wait until `size` bytes are free and take them.
+		:return: The bytes taken, to give back to `release`.
+		"""
+		size = min(size, self.capacity)
+		if not self.waiters and self.used + size <= self.capacity:
+			self.used += size
+			return size
+		future = asyncio.get_running_loop().create_future()
+		self.waiters.append((size, future))
+		started = time.monotonic()
+		try:
+			await future
+		except asyncio.CancelledError:
+			if future.done() and not future.cancelled():
+				self.release(size)
+			else:
+				self.wake()
+			raise
+		waited = time.monotonic() - started
+		self.waits += 1
+		self.wait_time += waited
+		self.max_wait = max(self.max_wait, waited)
+		return size
+
+	def release(self, size: int):
+		self.used -= size
+		self.wake()
+
+	def wake(self):
+		while self.waiters:
+			size, future = self.waiters[0]
+			if future.done():
+				self.waiters.popleft()
+			elif self.used + size <= self.capacity:
+				self.waiters.popleft()
+				self.used += size
+				future.set_result(None)
+			else:
+				break
+
+
+class UploadScheduler:
+	"""Queues sends to the archive channel so they go out at the pace its rate limit allows, live saves before bulk ones.
+
+	Sends are started in priority order, then first come first served, whenever the bucket has room. They aren't awaited
+	one after another, so a slow upload doesn't hold up the ones behind it.
+	"""
+
+	def __init__(self, capacity: int, period: float):
+		self.bucket = RateWindow(capacity, period)
+		self.queue = asyncio.PriorityQueue()
+		self.order = itertools.count()
+		self.depth = {LIVE: 0, BULK: 0}
+		self.sending = set()
+		self.task = None
+
+	@property
+	def in_flight(self) -> int:
+		"""How many sends are being made."""
+		return len(self.sending)
+
+	@property
+	def load(self) -> int:
+		"""How many sends are waiting or being made."""
+		return sum(self.depth.values()) + self.in_flight
+
+	def start(self):
+		if self.task is None or self.task.done():
+			self.task = asyncio.create_task(self.run())
+
+	def stop(self):
+		if self.task:
+			self.task.cancel()
+		for task in self.sending:
+			task.cancel()
+
+	async def submit(self, send, priority: int = LIVE):
+		"""Queue a send and wait for it to be made.
+		:param send: A function returning the coroutine that sends.
+		:param priority: `LIVE` or `BULK`.
+		:return: What the send returned.
+		"""
+		future = asyncio.get_running_loop().create_future()
+		self.queue.put_nowait((priority, next(self.order), send, future))
+		self.depth[priority] += 1
+		return await future
+
+	async def run(self):
+		while True:
+			priority, _, send, future = await self.queue.get()
+			self.depth[priority] -= 1
+			if future.done():
+				continue
+			await self.bucket.acquire()
+			# The caller may have given up while this waited for room, and closed what it was going to send.
+			if future.done():
+				continue
+			try:
+				coro = send()
+			except Exception as e:
+				future.set_exception(e)
+				continue
+			task = asyncio.create_task(coro)
+			self.sending.add(task)
+			task.add_done_callback(lambda task, f=future: self.finish(task, f))
+
+	def finish(self, task: asyncio.Task, future: asyncio.Future):
+		self.sending.discard(task)
+		if future.done():
+			return
+		if task.cancelled():
+			future.cancel()
+		elif task.exception():
+			future.set_exception(task.exception())
+		else:
+			future.set_result(task.result())
+
+
 class FileSave(commands.Cog):
 	"""Lets you save files sent in a thread."""
 
 	def __init__(self, bot):
 		self.bot: ModmailBot = bot
-		self.attachments_channel = None
+		self.archive_channels: List[discord.TextChannel] = []
 		self.db = bot.api.get_plugin_partition(self)
-		self.threads = []
+		self.jobs = self.db["jobs"]
+		self.job_added = asyncio.Event()
+		self.workers: List[asyncio.Task] = []
+		self.threads = set()
+		self.ready = asyncio.Event()
+		self.pending: collections.deque = collections.deque(maxlen=PENDING_LIMIT)
+		self.warmup: asyncio.Task = None
+		self.backfilling = False
+		self.config = DEFAULT_CONFIG.copy()
+		self.transfers = None
+		self.schedulers: Dict[int, UploadScheduler] = {}
+		self.budget = ByteBudget(self.config["memory_budget"] * 1024 * 1024)
+		self.metrics = Metrics()
+		self.apply_config()
+
+	def apply_config(self):
+		"""Rebuild whatever depends on the current settings."""
+		self.transfers = asyncio.Semaphore(max(self.config["concurrency"], 1))
+		for scheduler in self.schedulers.values():
+			scheduler.bucket.configure(self.config["upload_burst"], self.config["upload_period"])
+		self.budget.capacity = max(self.config["memory_budget"], 1) * 1024 * 1024
+		self.budget.wake()
 
 	async def cog_load(self):
-		await self.bot.threads.populate_cache()
-		if config := await self.db.find_one({"_id": "filesave"}):
-			if channel := self.bot.get_channel(config["channel"]):
-				self.attachments_channel = channel
+		# Loading the threads and settings waits on the bot's connection, so it mustn't hold up the plugin's loading.
+		self.warmup = asyncio.create_task(self.warm_up())
+
+	async def warm_up(self):
+		"""Load the thread index and settings, then start the background tasks and catch up on held messages."""
+		try:
+			await self.bot.wait_for_connected()
+			await self.bot.threads.populate_cache()
+			await self.load_config()
+			self.reconcile_threads()
+		except Exception as e:
+			logger.error(f"FileSave: Could not warm up: {e!r}")
+		# Each done on its own, so one failing doesn't keep the others from being done.
+		steps = (
+			("index the logs", lambda: self.bot.db["logs"].create_index([("channel_id", 1)])),
+			("index the archive jobs", lambda: self.jobs.create_index([("available_at", 1)])),
+			# Jobs still leased were interrupted by a restart, so they can be picked up right away.
+			(
+				"release the leases of archive jobs",
+				lambda: self.jobs.update_many({"lease": {"$ne": None}}, {"$set": {"lease": None}}),
+			),
+		)
+		for what, step in steps:
+			try:
+				await step()
+			except Exception as e:
+				logger.error(f"FileSave: Could not {what}: {e!r}")
+		self.start_workers()
+		self.dump_metrics.start()
+		self.thread_reconciler.start()
+		self.ready.set()
+		logger.debug(f"FileSave: Warmed up with {len(self.threads)} thread(s) and {len(self.pending)} held message(s).")
+		while self.pending:
+			message = self.pending.popleft()
+			try:
+				await self.on_message(message)
+			except Exception as e:
+				logger.error(f"FileSave: Could not archive held message {message.id}: {e!r}")
+
+	async def load_config(self):
+		config = await self.db.find_one({"_id": "filesave"})
+		if config:
+			self.config.update({k: v for k, v in config.items() if k in DEFAULT_CONFIG})
+			self.apply_config()
+		if not config:
+			return
+		# Before there was a pool, a single channel was kept as `channel`.
+		ids = config.get("channels", [config["channel"]] if "channel" in config else [])
+		self.archive_channels = []
+		for channel_id in ids:
+			if channel := self.bot.get_channel(channel_id):
+				self.archive_channels.append(channel)
 			else:
-				await self.fs_error("The set channel seems to no longer exist...\nIt will be changed back to the log channel.")
-				self.attachments_channel = self.bot.log_channel
-				await self.db.find_one_and_update({"_id": "filesave"}, {"$set": {"channel": self.bot.log_channel.id}})
+				await self.fs_error(f"Archive channel `{channel_id}` seems to no longer exist...\nIt was removed from the pool.")
+		if [channel.id for channel in self.archive_channels] != ids or "channel" in config:
+			await self.save_channels()
+
+	@property
+	def attachments_channel(self) -> discord.TextChannel:
+		"""The first archive channel, or the log channel if there are none."""
+		return self.archive_channels[0] if self.archive_channels else self.bot.log_channel
+
+	@property
+	def spool_size(self) -> int:
+		"""How many bytes of a file are kept in memory before it's moved to a temporary file."""
+		# A buffer of size 0 never rolls over, and would reserve nothing of the memory budget.
+		return max(self.config["spool_threshold"], 1) * 1024 * 1024
+
+	@property
+	def lease_time(self) -> datetime.timedelta:
+		"""How long a job is leased to a worker for."""
+		# A lease that's over as soon as it's taken would let another worker take the job too.
+		return datetime.timedelta(seconds=max(self.config["lease_timeout"], OPTION_MINIMUMS["lease_timeout"]))
+
+	async def save_channels(self):
+		await self.db.find_one_and_update(
+			{"_id": "filesave"},
+			{"$set": {"channels": [channel.id for channel in self.archive_channels]}, "$unset": {"channel": ""}},
+			upsert=True,
+		)
+
+	def scheduler_for(self, channel: discord.TextChannel) -> UploadScheduler:
+		"""The upload scheduler of a channel. Each channel has its own, since each has its own rate limit bucket."""
+		if channel.id not in self.schedulers:
+			self.schedulers[channel.id] = UploadScheduler(self.config["upload_burst"], self.config["upload_period"])
+			self.schedulers[channel.id].start()
+		return self.schedulers[channel.id]
+
+	def pick_channel(self, thread: int, exclude: set = frozenset()) -> discord.TextChannel:
+		"""Choose the archive channel for a thread's files, following the `pool_strategy` setting.
+		:param thread: The thread the files are from.
+		:param exclude: The IDs of channels not to use.
+		:return: The channel, or the log channel if the pool has none left.
+		"""
+		pool = [channel for channel in self.archive_channels if channel.id not in exclude]
+		if not pool:
+			return self.bot.log_channel
+		if self.config["pool_strategy"] == "hash":
+			return pool[thread % len(pool)]
+		return min(pool, key=lambda channel: self.scheduler_for(channel).load)
+
+	async def drop_channel(self, channel: discord.TextChannel, e: discord.HTTPException):
+		"""Take a channel that can't be sent to anymore out of the pool."""
+		self.metrics.inc("fallbacks")
+		if channel not in self.archive_channels:
+			# Another send already found out.
+			return
+		self.archive_channels.remove(channel)
+		await self.save_channels()
+		if isinstance(e, discord.http.Forbidden):
+			text = f"The bot seems to have lost a needed permission for archive channel <#{channel.id}>..."
 		else:
-			self.attachments_channel = self.bot.log_channel
-		self.threads = [self.bot.threads.cache[thread].channel.id for thread in self.bot.threads.cache]
+			text = f"Archive channel `{channel.id}` seems to no longer exist..."
+		text += "\nIt was removed from the pool."
+		if not self.archive_channels:
+			text += " Files will be sent to the log channel."
+		await self.fs_error(text)
+
+	async def cog_before_invoke(self, ctx):
+		# Commands need the archive channel and settings.
+		await self.ready.wait()
+
+	async def cog_unload(self):
+		if self.warmup:
+			self.warmup.cancel()
+		for worker in self.workers:
+			worker.cancel()
+		for scheduler in self.schedulers.values():
+			scheduler.stop()
+		self.dump_metrics.cancel()
+		self.thread_reconciler.cancel()
+
+	def reconcile_threads(self):
+		"""Rebuild the set of thread channels from the bot's thread cache, which the thread events can drift from."""
+		threads = {thread.channel.id for thread in self.bot.threads.cache.values() if getattr(thread, "channel", None)}
+		if threads != self.threads:
+			logger.debug(f"FileSave: Reconciled threads ({len(threads - self.threads)} added, {len(self.threads - threads)} removed).")
+		self.threads = threads
+
+	@tasks.loop(minutes=5)
+	async def thread_reconciler(self):
+		self.reconcile_threads()
+
+	@commands.Cog.listener()
+	async def on_ready(self):
+		self.reconcile_threads()
+
+	@commands.Cog.listener()
+	async def on_resumed(self):
+		self.reconcile_threads()
+
+	@tasks.loop(minutes=1)
+	async def dump_metrics(self):
+		"""Write the metrics to the `metrics_file` setting's file, if there is one, for Prometheus' textfile collector."""
+		if path := self.config["metrics_file"]:
+
+			def write(text):
+				# Written next to the file and then moved, so a scrape never sees half of it.
+				with open(f"{path}.tmp", "w") as f:
+					f.write(text)
+				os.replace(f"{path}.tmp", path)
+
+			try:
+				await asyncio.to_thread(write, self.metrics.prometheus())
+			except OSError as e:
+				logger.error(f"FileSave: Could not write the metrics to {path}: {e!r}")
+
+	def failure(self, e: BaseException):
+		self.metrics.inc("failures", type(e).__name__)
+
+	def start_workers(self):
+		"""(Re)start the workers that go through the job queue."""
+		for worker in self.workers:
+			worker.cancel()
+		self.workers = [asyncio.create_task(self.worker()) for _ in range(max(self.config["workers"], 1))]
 
 	async def fs_error(self, text: str):
 		await self.bot.log_channel.send(embed=discord.Embed(title="FileSave", description=text, color=self.bot.error_color))
 
-	async def send_file(self, file, filename=None, image: bool = False):
-		try:
-			msg = await self.attachments_channel.send(file=discord.File(file, filename))
-		except (discord.http.Forbidden, discord.http.NotFound) as e:
-			if isinstance(e, discord.http.Forbidden):
-				await self.fs_error(
-					"The bot seems to have lost a needed permission for the set channel...\nIt will be changed back to the log channel."
-				)
-			else:
-				await self.fs_error("The set channel seems to no longer exist...\nIt will be changed back to the log channel.")
-			if image:
-				file.seek(0)
-			self.attachments_channel = self.bot.log_channel
-			await self.db.find_one_and_update({"_id": "filesave"}, {"$set": {"channel": self.bot.log_channel.id}})
-			msg = await self.attachments_channel.send(file=discord.File(file, filename))
+	async def send_file(self, *files: Tuple[io.IOBase, str], priority: int = LIVE, thread: int = 0) -> discord.Message:
+		"""Send files to an archive channel in a single message, through that channel's upload scheduler.
+
+		If the channel is gone or can't be sent to anymore, it's dropped from the pool and the next one is tried.
+		:param files: Tuples of a file-like object and the filename to use.
+		:param priority: `LIVE` or `BULK`.
+		:param thread: The thread the files are from, which the channel is chosen by.
+		:return: The sent message.
+		"""
+
+		def build():
+			for fp, _ in files:
+				fp.seek(0)
+			return [discord.File(fp, filename) for fp, filename in files]
+
+		size = 0
+		for fp, _ in files:
+			size += fp.seek(0, io.SEEK_END)
+
+		tried = set()
+		while True:
+			channel = self.pick_channel(thread, tried)
+			try:
+				with self.metrics.timer("upload"):
+					msg = await self.scheduler_for(channel).submit(lambda: channel.send(files=build()), priority)
+				break
+			except (discord.http.Forbidden, discord.http.NotFound) as e:
+				if channel == self.bot.log_channel:
+					raise
+				tried.add(channel.id)
+				await self.drop_channel(channel, e)
+		self.metrics.inc("bytes_uploaded", value=size)
+		self.metrics.inc("files_archived", value=len(files))
 		return msg
 
-	async def save_file(self, message: discord.Message, thread: int):
-		async with aiofiles.tempfile.TemporaryDirectory(dir=".\\temp") as tempdir:
-			for att in message.attachments:
+	async def download(self, att: discord.Attachment) -> Tuple[Tuple[io.IOBase, str], str]:
+		"""Stream an attachment in chunks once a transfer slot is free, so it's never held in memory all at once.
+
+		It goes to a buffer that stays in memory, and is uploaded from there, unless it grows past the `spool_threshold`
+		setting (in MB). Only then is it moved to a file in the system's temporary directory.
+		The content is hashed as it arrives, in a worker thread so big files don't hold up the event loop.
+		:param att: The attachment to download.
+		:return: A file-like object and its filename, as taken by `send_file`, and its key in the file index.
+		"""
+		digest = hashlib.sha256()
+		size = 0
+		threshold = self.spool_size
+		buffer = tempfile.SpooledTemporaryFile(max_size=threshold)
+		try:
+			async with self.transfers:
+				started = time.monotonic()
 				async with self.bot.session.get(att.url) as resp:
-					file = await resp.read()
-					if att.content_type and "image" in att.content_type:
-						msg = await self.send_file(io.BytesIO(file), att.filename, image=True)
-					else:
-						path = f"{tempdir}\\{att.filename}"
-						async with aiofiles.open(path, mode="wb") as f:
-							await f.write(file)
-						msg = await self.send_file(path)
-				await self.bot.db["logs"].update_one(
+					resp.raise_for_status()
+					async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+						await asyncio.to_thread(digest.update, chunk)
+						size += len(chunk)
+						if size > threshold:
+							# Past the threshold the buffer is on disk.
+							await asyncio.to_thread(buffer.write, chunk)
+						else:
+							buffer.write(chunk)
+				self.metrics.observe("download", time.monotonic() - started)
+		except BaseException:
+			buffer.close()
+			raise
+		finally:
+			self.metrics.inc("bytes_downloaded", value=size)
+		return (buffer, att.filename), f"sha256:{digest.hexdigest()}:{size}"
+
+	async def enqueue(self, attachments: List[discord.Attachment], thread: int, message_id: int, priority: int = LIVE):
+		"""Add an archive job for a message's attachments."""
+		await self.jobs.insert_one(
+			{
+				"message_id": message_id,
+				"thread": thread,
+				"priority": priority,
+				"attachments": [JobAttachment.from_attachment(att)._asdict() for att in attachments],
+				"attempts": 0,
+				"available_at": datetime.datetime.now(datetime.timezone.utc),
+				"lease": None,
+			}
+		)
+		self.job_added.set()
+
+	async def claim_job(self):
+		"""Lease the next job that's due, if there is one."""
+		now = datetime.datetime.now(datetime.timezone.utc)
+		return await self.jobs.find_one_and_update(
+			{"failed": {"$ne": True}, "available_at": {"$lte": now}, "$or": [{"lease": None}, {"lease": {"$lt": now}}]},
+			{"$set": {"lease": now + self.lease_time}, "$inc": {"attempts": 1}},
+			sort=[("available_at", 1)],
+			return_document=True,
+		)
+
+	async def renew_lease(self, job: dict):
+		"""Keep a job leased for as long as it's being worked on."""
+		while True:
+			await asyncio.sleep(self.lease_time.total_seconds() / 2)
+			lease = datetime.datetime.now(datetime.timezone.utc) + self.lease_time
+			await self.jobs.update_one({"_id": job["_id"]}, {"$set": {"lease": lease}})
+
+	async def run_job(self, job: dict):
+		"""Archive a job's attachments, then remove it or schedule a retry for the ones that failed."""
+		renewal = asyncio.create_task(self.renew_lease(job))
+		try:
+			failed = await self.save_file(
+				[JobAttachment(**att) for att in job["attachments"]], job["thread"], job.get("priority", LIVE)
+			)
+		except asyncio.CancelledError:
+			await self.jobs.update_one({"_id": job["_id"]}, {"$set": {"lease": None}})
+			raise
+		except Exception as e:
+			logger.error(f"FileSave: Archive job {job['_id']} failed: {e!r}")
+			failed = job["attachments"]
+		else:
+			failed = [att._asdict() if isinstance(att, JobAttachment) else att for att in failed]
+		finally:
+			renewal.cancel()
+
+		if not failed:
+			await self.jobs.delete_one({"_id": job["_id"]})
+		elif job["attempts"] >= self.config["max_attempts"]:
+			logger.error(
+				f"FileSave: Giving up on {len(failed)} attachment(s) of message {job['message_id']} after {job['attempts']} attempts."
+			)
+			await self.jobs.update_one({"_id": job["_id"]}, {"$set": {"attachments": failed, "failed": True, "lease": None}})
+		else:
+			when = datetime.datetime.now(datetime.timezone.utc) + backoff(job["attempts"])
+			await self.jobs.update_one({"_id": job["_id"]}, {"$set": {"attachments": failed, "available_at": when, "lease": None}})
+
+	async def worker(self):
+		"""Go through the job queue until cancelled."""
+		while True:
+			# Cleared before looking, so a job added while the query runs still wakes this worker.
+			self.job_added.clear()
+			try:
+				job = await self.claim_job()
+			except Exception as e:
+				logger.error(f"FileSave: Could not get an archive job: {e!r}")
+				job = None
+			if job is None:
+				try:
+					await asyncio.wait_for(self.job_added.wait(), timeout=POLL_INTERVAL)
+				except asyncio.TimeoutError:
+					pass
+				continue
+			try:
+				await self.run_job(job)
+			except asyncio.CancelledError:
+				raise
+			except Exception as e:
+				logger.error(f"FileSave: Archive job {job['_id']} failed: {e!r}")
+
+	async def update_log(self, thread: int, rewrites: List[Tuple[Union[discord.Attachment, JobAttachment], str]]):
+		"""Point a thread's log at archived urls in a single bulk write.
+
+		Each update in it rewrites up to `REWRITES_PER_UPDATE` urls, each matched by its own array filter.
+		:param thread: The thread of the log.
+		:param rewrites: Tuples of an attachment and its archived url.
+		"""
+		urls = list({att.url: url for att, url in rewrites}.items())
+		if not urls:
+			return
+		updates = []
+		for pos in range(0, len(urls), REWRITES_PER_UPDATE):
+			chunk = urls[pos : pos + REWRITES_PER_UPDATE]
+			updates.append(
+				UpdateOne(
 					{"channel_id": str(thread)},
-					{"$set": {"messages.$[].attachments.$[x].url": msg.attachments[0].url}},
-					array_filters=[{"x.url": att.url}],
+					{"$set": {f"messages.$[].attachments.$[a{i}].url": new for i, (_, new) in enumerate(chunk)}},
+					array_filters=[{f"a{i}.url": old} for i, (old, _) in enumerate(chunk)],
 				)
+			)
+		with self.metrics.timer("log_update"):
+			await self.bot.db["logs"].bulk_write(updates, ordered=False)
+
+	async def archive_batch(
+		self, files: List[Tuple[discord.Attachment, tuple, str]], thread: int, rewrites: list, priority: int = LIVE
+	) -> list:
+		"""Send downloaded attachments in one message and add them to the file index.
+
+		If the message can't be sent, the attachments are retried one by one so a single bad file doesn't lose the rest.
+		:param rewrites: Where the new urls are added, as taken by `update_log`.
+		:return: The attachments that could not be archived.
+		"""
+		if not files:
+			return []
+		try:
+			msg = await self.send_file(*[file for _, file, _ in files], priority=priority, thread=thread)
+		except discord.HTTPException as e:
+			if len(files) > 1:
+				failed = []
+				for file in files:
+					failed += await self.archive_batch([file], thread, rewrites, priority)
+				return failed
+			logger.error(f"FileSave: Could not archive {files[0][0].filename} ({files[0][0].id}) from {thread}: {e!r}")
+			self.failure(e)
+			return [files[0][0]]
+		try:
+			# Indexed before the log is updated so a retry finds the upload and only has to update the log.
+			# Set rather than only inserted, since an entry can be left pointing into a channel that was dropped.
+			await self.db.bulk_write(
+				[
+					UpdateOne({"_id": key}, {"$set": {"url": archived.url, "channel": msg.channel.id}}, upsert=True)
+					for (_, _, key), archived in zip(files, msg.attachments)
+				],
+				ordered=False,
+			)
+		except Exception as e:
+			logger.error(f"FileSave: Could not add files from {thread} to the file index: {e!r}")
+			self.failure(e)
+		rewrites += [(att, archived.url) for (att, _, _), archived in zip(files, msg.attachments)]
+		return []
+
+	async def archive_bundle(
+		self, files: List[Tuple[discord.Attachment, tuple, str]], thread: int, rewrites: list, priority: int = LIVE
+	) -> list:
+		"""Send downloaded attachments packed in a single zip, then add them to the file index.
+
+		Their archived urls are the zip's with the file's name in the zip as the fragment, e.g. `.../bundle.zip#notes.txt`.
+		If the zip can't be made or sent, the attachments are sent as they are instead.
+		:param rewrites: Where the new urls are added, as taken by `update_log`.
+		:return: The attachments that could not be archived.
+		"""
+		if len(files) < BUNDLE_MIN:
+			return await self.archive_batch(files, thread, rewrites, priority)
+		try:
+			with self.metrics.timer("bundle"):
+				bundle, members = await asyncio.to_thread(build_bundle, files, self.spool_size)
+		except Exception as e:
+			logger.error(f"FileSave: Could not bundle {len(files)} files from {thread}: {e!r}")
+			self.failure(e)
+			return await self.archive_batch(files, thread, rewrites, priority)
+		try:
+			msg = await self.send_file((bundle, f"bundle-{files[0][0].id}.zip"), priority=priority, thread=thread)
+		except discord.HTTPException as e:
+			logger.warning(
+				f"FileSave: Could not send a bundle of {len(files)} files from {thread}, sending them as they are: {e!r}"
+			)
+			self.failure(e)
+			return await self.archive_batch(files, thread, rewrites, priority)
+		finally:
+			bundle.close()
+		urls = [(att, f"{msg.attachments[0].url}#{members[att.id]}") for att, _, _ in files]
+		self.metrics.inc("files_bundled", value=len(files))
+		try:
+			await self.db.bulk_write(
+				[
+					UpdateOne({"_id": key}, {"$set": {"url": url, "channel": msg.channel.id}}, upsert=True)
+					for (_, _, key), (_, url) in zip(files, urls)
+				],
+				ordered=False,
+			)
+		except Exception as e:
+			logger.error(f"FileSave: Could not add files from {thread} to the file index: {e!r}")
+			self.failure(e)
+		rewrites += urls
+		return []
+
+	def bundles(self, att: Union[discord.Attachment, JobAttachment]) -> bool:
+		"""Whether an attachment goes in a bundle, with the `bundle` setting on."""
+		content_type = (att.content_type or "").lower()
+		return not content_type.startswith("image/") and att.size <= self.config["bundle_threshold"] * 1024
+
+	def check_policy(self, att: Union[discord.Attachment, JobAttachment]):
+		"""Check an attachment's metadata against the file policy, before anything is downloaded.
+		:param att: The attachment to check.
+		:return: Why the attachment won't be archived, and whether that's because of its size. None if it's fine.
+		"""
+		content_type = (att.content_type or "").split(";")[0].strip().lower()
+		if self.config["allow_types"] and not any(mime_matches(content_type, p) for p in self.config["allow_types"]):
+			return f"its type ({content_type or 'unknown'}) is not allowed", False
+		if any(mime_matches(content_type, p) for p in self.config["deny_types"]):
+			return f"its type ({content_type}) is denied", False
+		limit = self.attachments_channel.guild.filesize_limit
+		if self.config["max_size"]:
+			limit = min(limit, self.config["max_size"] * 1024 * 1024)
+		if att.size > limit:
+			return f"it's bigger than {format_size(limit)}", True
+		return None
+
+	async def reject(self, att: Union[discord.Attachment, JobAttachment], thread: int, reason: str, oversize: bool, priority: int):
+		"""Handle an attachment the file policy won't let through."""
+		logger.info(f"FileSave: Not archiving {att.filename} ({att.id}) from {thread}: {reason}.")
+		self.metrics.inc("files_rejected")
+		if oversize and self.config["oversize"] == "reference":
+			embed = discord.Embed(
+				title=att.filename,
+				url=att.url,
+				description=f"Not archived because {reason}.\n**Size**: {format_size(att.size)}\n**Thread**: <#{thread}>",
+				color=self.bot.error_color,
+			)
+			channel = self.pick_channel(thread)
+			await self.scheduler_for(channel).submit(lambda: channel.send(embed=embed), priority)
+
+	async def save_file(
+		self,
+		attachments: List[Union[discord.Attachment, JobAttachment]],
+		thread: int,
+		priority: int = LIVE,
+		rewrites: list = None,
+	) -> list:
+		"""Archive the attachments of a message.
+
+		Attachments are downloaded concurrently (up to the `concurrency` setting, shared by every save) and, with `batch` on,
+		sent in as few messages as Discord's limits allow, keeping their original order. An attachment that fails is logged
+		and skipped without affecting the others.
+
+		Files that were archived before (same SHA-256 and size) aren't sent again; the log just gets the archived url.
+		Attachments the file policy rejects are never downloaded.
+		With the `bundle` setting on, a message's small files that aren't images are sent together in a zip after the rest.
+		Uploads made for bulk work (`priority` of `BULK`) wait for live ones.
+		Every save shares the `memory_budget` setting (in MB): a batch's downloads wait until the part of its files that can
+		be held in memory (up to `spool_threshold` each) fits in it, and give it back once the batch is sent.
+		The log is updated once for all of the message's attachments, or not at all if `rewrites` is given: the new urls
+		are added to it instead, for the caller to write together with others.
+		:return: The attachments that could not be archived.
+		"""
+		started = time.monotonic()
+		failed = []
+		collected = []
+		allowed = []
+		for att in attachments:
+			if rejection := self.check_policy(att):
+				try:
+					await self.reject(att, thread, *rejection, priority)
+				except discord.HTTPException as e:
+					logger.error(f"FileSave: Could not post a reference to {att.filename} ({att.id}) from {thread}: {e!r}")
+					self.failure(e)
+			else:
+				allowed.append(att)
+		attachments = allowed
+		if not attachments:
+			return failed
+		bundled = set()
+		if self.config["bundle"]:
+			small = [att for att in attachments if self.bundles(att)]
+			if len(small) >= BUNDLE_MIN:
+				bundled = {att.id for att in small}
+		batches = batch_attachments(
+			[att for att in attachments if att.id not in bundled],
+			self.attachments_channel.guild.filesize_limit,
+			MAX_FILES if self.config["batch"] else 1,
+		)
+		batches += batch_attachments(
+			[att for att in attachments if att.id in bundled],
+			max(self.attachments_channel.guild.filesize_limit - BUNDLE_HEADROOM, 1),
+			BUNDLE_FILES,
+		)
+		spool = self.spool_size
+		# A batch reserves all of its bytes at once, so batches waiting on each other can't deadlock the budget.
+		reservations = [
+			asyncio.create_task(self.budget.acquire(sum(min(att.size, spool) for att in batch))) for batch in batches
+		]
+
+		async def fetch(att, reservation):
+			await asyncio.shield(reservation)
+			return await self.download(att)
+
+		downloads = {
+			att.id: asyncio.create_task(fetch(att, reservation))
+			for batch, reservation in zip(batches, reservations)
+			for att in batch
+		}
+		remaining = collections.deque(zip(batches, reservations))
+
+		def close(batch, reservation):
+			for att in batch:
+				download = downloads[att.id]
+				if download.done() and not download.cancelled() and not download.exception():
+					download.result()[0][0].close()
+			if reservation.done() and not reservation.cancelled() and not reservation.exception():
+				self.budget.release(reservation.result())
+
+		try:
+			while remaining:
+				batch, reservation = remaining[0]
+				files = []
+				for att in batch:
+					try:
+						file, key = await downloads[att.id]
+					except Exception as e:
+						logger.error(f"FileSave: Could not archive {att.filename} ({att.id}) from {thread}: {e!r}")
+						self.failure(e)
+						failed.append(att)
+					else:
+						files.append((att, file, key))
+				if files:
+					# Entries in channels that were dropped from the pool don't count, their files may be gone.
+					channels = self.archive_channel_ids()
+					archived = {
+						doc["_id"]: doc["url"]
+						async for doc in self.db.find({"_id": {"$in": [key for _, _, key in files]}})
+						if index_channel(doc) in channels
+					}
+					collected += [(att, archived[key]) for att, _, key in files if key in archived]
+					self.metrics.inc("files_deduplicated", value=sum(key in archived for _, _, key in files))
+					archive = self.archive_bundle if batch[0].id in bundled else self.archive_batch
+					failed += await archive([file for file in files if file[2] not in archived], thread, collected, priority)
+				remaining.popleft()
+				close(batch, reservation)
+		finally:
+			tasks = [downloads[att.id] for batch, _ in remaining for att in batch] + [r for _, r in remaining]
+			for task in tasks:
+				task.cancel()
+			await asyncio.gather(*tasks, return_exceptions=True)
+			for batch, reservation in remaining:
+				close(batch, reservation)
+		if rewrites is not None:
+			rewrites += collected
+		elif collected:
+			try:
+				await self.update_log(thread, collected)
+			except Exception as e:
+				logger.error(f"FileSave: Could not update the log urls of {len(collected)} attachment(s) from {thread}: {e!r}")
+				self.failure(e)
+				failed += [att for att, _ in collected]
+		self.metrics.observe("save", time.monotonic() - started)
+		return failed
 
 	@commands.Cog.listener()
 	async def on_message(self, message: discord.Message):
-		if message.channel.id in self.threads and message.author.id != self.bot.user.id and message.attachments:
-			await self.save_file(message, message.channel.id)
+		if not self.ready.is_set():
+			# Which channels are threads isn't known yet, so hold on to anything that might need saving.
+			if message.attachments and message.author.id != self.bot.user.id:
+				if len(self.pending) == self.pending.maxlen:
+					logger.warning(f"FileSave: Dropped held message {self.pending[0].id} while warming up.")
+				self.pending.append(message)
+			return
+		if message.attachments and message.channel.id in self.threads and message.author.id != self.bot.user.id:
+			await self.enqueue(message.attachments, message.channel.id, message.id)
 
 	@commands.Cog.listener()
 	async def on_thread_ready(self, thread, creator, category, initial_message):
-		self.threads.append(thread.channel.id)
+		self.threads.add(thread.channel.id)
 
 	@commands.Cog.listener()
 	async def on_thread_close(self, thread, closer, silent, delete_channel, message, scheduled):
-		self.threads.remove(thread.channel.id)
+		self.threads.discard(thread.channel.id)
 
 	@commands.group(name="filesave", aliases=["fs"], brief="FileSave commands.")
 	@checks.has_permissions(checks.PermissionLevel.ADMIN)
 	async def filesave(self, ctx):
 		"""`FileSave` aims to help moderators who want to perserve files they send in threads.\n
 		Whenever a message with attachments is sent in a thread, the attachments are sent again in another channel by the bot.\n
-		It works out of the box; by default files are sent to the **logging channel**, but the channel can be customized.\n
-		Archived files will also have their url updated in the database logs.
+		It works out of the box; by default files are sent to the **logging channel**, but the channel can be customized.
+		Several channels can be set, so uploads are spread over their rate limits.\n
+		Archived files will also have their url updated in the database logs.\n
+		Files that were already archived once, in any thread, aren't sent again.
 		"""
 
+	async def check_channel(self, ctx, channel: Union[int, discord.TextChannel]) -> Union[discord.TextChannel, None]:
+		"""Get the channel given to a command, if files can be archived in it. Tells the user why not otherwise."""
+		if not isinstance(channel, discord.TextChannel):
+			channel = self.bot.get_channel(channel)
+			if not isinstance(channel, discord.TextChannel):
+				await self.bot.add_reaction(ctx.message, "❌")
+				return None
+		permissions = channel.permissions_for(channel.guild.me)
+		if not (permissions.view_channel and permissions.send_messages and permissions.attach_files):
+			await ctx.send("Invalid permissions for that channel!...")
+			return None
+		return channel
+
 	@filesave.command(brief="Set the file archive channel.")
 	@checks.has_permissions(checks.PermissionLevel.ADMIN)
 	async def setchannel(self, ctx, channel: Union[int, discord.TextChannel]):
-		"""Set the file archive channel. It is the log channel by default. You can pass an actual channel or just its ID."""
-		if not isinstance(channel, discord.TextChannel):
-			try:
-				channel = int(channel)
-			except ValueError:
-				return await self.bot.add_reaction(ctx.message, "❌")
-			else:
-				self.attachments_channel = self.bot.get_channel(channel)
-				await self.db.find_one_and_update({"_id": "filesave"}, {"$set": {"channel": channel}}, upsert=True)
-		else:
-			if channel.permissions_for(ctx.guild.me).view_channel and channel.permissions_for(ctx.guild.me).send_messages:
-				self.attachments_channel = channel
-				await self.db.find_one_and_update({"_id": "filesave"}, {"$set": {"channel": channel.id}}, upsert=True)
-			else:
-				return await ctx.send("Invalid permissions for that channel!...")
+		"""Set the file archive channel, replacing any others. It is the log channel by default.
+		You can pass an actual channel or just its ID."""
+		if not (channel := await self.check_channel(ctx, channel)):
+			return
+		self.archive_channels = [channel]
+		await self.save_channels()
+		return await self.bot.add_reaction(ctx.message, "✅")
+
+	@filesave.command(brief="Add an archive channel to the pool.")
+	@checks.has_permissions(checks.PermissionLevel.ADMIN)
+	async def addchannel(self, ctx, channel: Union[int, discord.TextChannel]):
+		"""Add a channel to the archive channels. Each one has its own rate limit, so every channel added lets files be
+		archived faster. Which one a file goes to depends on the `pool_strategy` setting."""
+		if not (channel := await self.check_channel(ctx, channel)):
+			return
+		if channel not in self.archive_channels:
+			self.archive_channels.append(channel)
+			await self.save_channels()
 		return await self.bot.add_reaction(ctx.message, "✅")
 
+	@filesave.command(brief="Remove an archive channel from the pool.")
+	@checks.has_permissions(checks.PermissionLevel.ADMIN)
+	async def removechannel(self, ctx, channel: Union[int, discord.TextChannel]):
+		"""Remove a channel from the archive channels. Files go to the log channel once there are none left."""
+		channel_id = channel.id if isinstance(channel, discord.TextChannel) else channel
+		if not any(c.id == channel_id for c in self.archive_channels):
+			return await self.bot.add_reaction(ctx.message, "❌")
+		self.archive_channels = [c for c in self.archive_channels if c.id != channel_id]
+		await self.save_channels()
+		return await self.bot.add_reaction(ctx.message, "✅")
+
+	@filesave.command(name="config", brief="View or change settings.")
+	@checks.has_permissions(checks.PermissionLevel.ADMIN)
+	async def configure(self, ctx, option: str = None, *, value: str = None):
+		"""View or change FileSave's settings. Use it by itself to see the current ones.
+		### Options
+		- `concurrency` - How many attachments can be downloaded at the same time, across all threads.
+		- `batch` - Whether to send up to 10 attachments of a message together instead of one message each.
+		- `spool_threshold` - How many MB of a file are kept in memory before it's moved to a temporary file. At least `1`.
+		- `workers` - How many archive jobs are worked on at the same time.
+		- `max_attempts` - How many times a job is tried before giving up on it.
+		- `lease_timeout` - How many seconds a worker has to finish a job before another one can take it. At least `30`.
+		- `allow_types` - Only archive files of these MIME types (e.g. `image/ video/mp4`). Everything is allowed if empty.
+		- `deny_types` - Never archive files of these MIME types. Use `none` to clear either list.
+		- `max_size` - The biggest file to archive, in MB. `0` only uses the server's upload limit.
+		- `oversize` - What to do with files that are too big: `skip` them (only logged) or post a `reference` to them.
+		- `upload_burst`/`upload_period` - How many uploads each archive channel takes per that many seconds.
+		- `memory_budget` - How many MB of files can be held in memory at once, across all threads.
+		- `metrics_file` - A `.prom` file the stats are written to every minute, for Prometheus' textfile collector.
+		- `backfill_rate` - How many attachments `backfill` starts archiving per minute. `0` doesn't limit it.
+		- `pool_strategy` - How the archive channel is chosen: by `hash` of the thread, keeping a thread's files together, or
+		the one with the least uploads waiting (`load`).
+		- `bundle` - Whether to pack a message's small files that aren't images in a single zip, with a manifest.
+		- `bundle_threshold` - The biggest file that goes in a bundle, in KB.
+		"""
+		if not option:
+			embed = discord.Embed(
+				title="FileSave",
+				description="\n".join(f"- `{k}`: `{v}`" for k, v in self.config.items()),
+				color=self.bot.main_color,
+			)
+			embed.add_field(
+				name="Archive channels",
+				value="\n".join(f"- <#{c.id}>" for c in self.archive_channels) or f"- <#{self.bot.log_channel.id}> (log channel)",
+			)
+			return await ctx.send(embed=embed)
+		option = option.lower()
+		if option not in DEFAULT_CONFIG:
+			return await ctx.send("Invalid option. Use `?filesave config` to see them.")
+		if value is None:
+			return await ctx.send(f"`{option}` is currently `{self.config[option]}`.")
+		try:
+			value = convert_option(option, value)
+		except ValueError:
+			return await ctx.send("Invalid value for that option.")
+		self.config[option] = value
+		self.apply_config()
+		if option == "workers":
+			self.start_workers()
+		await self.db.find_one_and_update({"_id": "filesave"}, {"$set": {option: value}}, upsert=True)
+		return await self.bot.add_reaction(ctx.message, "✅")
+
+	@filesave.command(brief="Show what's waiting to be archived.")
+	@checks.has_permissions(checks.PermissionLevel.ADMIN)
+	async def queue(self, ctx):
+		"""Show how many uploads and archive jobs are waiting, and how much of the memory budget is in use."""
+		now = datetime.datetime.now(datetime.timezone.utc)
+		due = await self.jobs.count_documents({"failed": {"$ne": True}, "available_at": {"$lte": now}})
+		retrying = await self.jobs.count_documents({"failed": {"$ne": True}, "available_at": {"$gt": now}})
+		failed = await self.jobs.count_documents({"failed": True})
+		embed = discord.Embed(title="FileSave", color=self.bot.main_color)
+		schedulers = self.schedulers.values()
+		uploads = (
+			f"- **Live**: {sum(s.depth[LIVE] for s in schedulers)}\n- **Bulk**: {sum(s.depth[BULK] for s in schedulers)}"
+			f"\n- **Sending**: {sum(s.in_flight for s in schedulers)}"
+		)
+		if len(self.schedulers) > 1:
+			uploads += "".join(f"\n- <#{channel_id}>: {s.load}" for channel_id, s in self.schedulers.items())
+		embed.add_field(name="Uploads", value=uploads)
+		embed.add_field(name="Jobs", value=f"- **Due**: {due}\n- **Retrying later**: {retrying}\n- **Failed**: {failed}")
+		budget = self.budget
+		embed.add_field(
+			name="Memory",
+			value=(
+				f"- **In use**: {format_size(budget.used)} of {format_size(budget.capacity)}"
+				f"\n- **Waiting**: {sum(not future.done() for _, future in budget.waiters)}"
+				f"\n- **Average wait**: {budget.wait_time / budget.waits if budget.waits else 0:.2f}s"
+				f"\n- **Longest wait**: {budget.max_wait:.2f}s"
+			),
+		)
+		return await ctx.send(embed=embed)
+
+	@filesave.command(brief="Show archive stats.")
+	@checks.has_permissions(checks.PermissionLevel.ADMIN)
+	async def stats(self, ctx):
+		"""Show what archiving has cost since the plugin was loaded: bytes moved, how long each step takes and what failed.
+
+		Latencies are estimated from histogram buckets, so they're upper bounds.
+		"""
+		metrics = self.metrics
+		counters = metrics.counters
+		embed = discord.Embed(title="FileSave", color=self.bot.main_color)
+		embed.add_field(
+			name="Files",
+			value=(
+				f"- **Archived**: {counters['files_archived']['']}"
+				f"\n- **Deduplicated**: {counters['files_deduplicated']['']}"
+				f"\n- **Rejected**: {counters['files_rejected']['']}"
+				f"\n- **Downloaded**: {format_size(counters['bytes_downloaded'][''])}"
+				f"\n- **Uploaded**: {format_size(counters['bytes_uploaded'][''])}"
+				f"\n- **Archive channels dropped**: {counters['fallbacks']['']}"
+			),
+		)
+		if metrics.histograms:
+			embed.add_field(
+				name="Latency",
+				value="\n".join(
+					f"- **{stage}**: {h['count']} × avg {h['sum'] / h['count']:.2f}s, p50 ≤ {metrics.quantile(stage, 0.5)}s, "
+					f"p99 ≤ {metrics.quantile(stage, 0.99)}s"
+					for stage, h in metrics.histograms.items()
+				),
+				inline=False,
+			)
+		if counters["failures"]:
+			embed.add_field(
+				name="Failures",
+				value="\n".join(f"- **{name}**: {count}" for name, count in counters["failures"].most_common()),
+				inline=False,
+			)
+		return await ctx.send(embed=embed)
+
 	class ArchiveChannelFlags(commands.FlagConverter, case_insensitive=True, delimiter=" ", prefix="-"):
 		limit: Union[int, None] = commands.flag(name="limit", aliases=["lim"], description="Only this amount of messages")
 		oldest: Union[bool, None] = commands.flag(name="oldest", description="Whether to start from the oldest messages first")
-		before: Union[int, None] = commands.flag(name="before", description="After this message")
-		after: Union[int, None] = commands.flag(name="after", description="Before this message")
+		before: Union[int, None] = commands.flag(name="before", description="Before this message")
+		after: Union[int, None] = commands.flag(name="after", description="After this message")
+		fresh: Union[bool, None] = commands.flag(name="fresh", description="Start over instead of resuming")
 
 	@filesave.command(brief="Save all attachments in a channel.")
 	@checks.has_permissions(checks.PermissionLevel.ADMIN)
@@ -161,31 +1418,324 @@ class FileSave(commands.Cog):
 		"""Itrates a thread's message history and archives files sent.
 		### Flags
 		Syntax: `-flagname argument`
-		- `limit`/`lim` - Only this amount of messages. Only accounts for ones with attachments.
+		- `limit`/`lim` - Only this amount of messages this run. Only accounts for ones with attachments.
 		- `oldest` - Whether to start from the oldest messages first.
-		- `before` - Only before this date.
-		- `after` - Only before this date. `oldest` is *`True`* if this is used.
+		- `before` - Only before this message.
+		- `after` - Only after this message. `oldest` is *`True`* if this is used.
+		- `fresh` - Start over instead of resuming where the last run stopped.
+
+		Messages are saved while the history is still being fetched, up to the `concurrency` setting at a time.
+		Progress is saved as it goes, so running the command again continues where an interrupted run stopped.
+		Attachments that fail are queued to be retried later.
 		"""
-		if flags and flags.limit:
-			counter = 0
-		else:
-			counter = None
-		if not flags:
+		limit = flags.limit if flags and flags.limit else None
+		oldest = bool(flags and (flags.oldest or flags.after))
+		after = discord.Object(flags.after) if flags and flags.after else None
+		before = discord.Object(flags.before) if flags and flags.before else None
+		count = 0
+
+		checkpoint_id = f"archivethread:{ctx.channel.id}"
+		checkpoint = None if flags and flags.fresh else await self.db.find_one({"_id": checkpoint_id})
+		if checkpoint and checkpoint["oldest"] == oldest:
+			if oldest:
+				after = discord.Object(checkpoint["last"])
+			else:
+				before = discord.Object(checkpoint["last"])
+			count = checkpoint["count"]
+			await ctx.send(f"Resuming from where the last run stopped ({count} messages with attachments were done).")
+		elif not flags:
 			if not await confirmation(
 				ctx, "This will post **every** attachment in this channel in your designated archive channel. Are you sure?"
 			):
 				return
-		async for msg in ctx.channel.history(
-			oldest_first=flags.oldest if flags and flags.oldest else None,
-			after=await ctx.fetch_message(flags.after) if flags and flags.after else None,
-			before=await ctx.fetch_message(flags.before) if flags and flags.after else None,
-		):
-			if counter is not None and counter == flags.limit:
-				return await self.bot.add_reaction(ctx.message, "✅")
-			if msg.attachments:
-				if counter is not None:
-					counter += 1
-				await self.save_file(msg, ctx.channel.id)
+
+		if oldest:
+			end = before.id if before else ctx.channel.last_message_id
+		else:
+			end = after.id if after else ctx.channel.id
+		start = None
+		last = None
+		count_run = 0
+		files = 0
+		failures = 0
+		started = time.monotonic()
+		reported = started
+
+		slots = asyncio.Semaphore(max(self.config["concurrency"], 1))
+		pending = collections.deque()
+		rewrites = []
+
+		async def save(msg: discord.Message):
+			nonlocal files, failures
+			try:
+				failed = await self.save_file(msg.attachments, ctx.channel.id, BULK, rewrites)
+				if failed:
+					failures += len(failed)
+					await self.enqueue(failed, ctx.channel.id, msg.id, BULK)
+				files += len(msg.attachments) - len(failed)
+			finally:
+				slots.release()
+
+		def advance():
+			# The checkpoint can only move past messages whose saves, and every one before them, have finished.
+			nonlocal last
+			while pending and (pending[0][1] is None or pending[0][1].done()):
+				last = pending.popleft()[0]
+
+		async def report(final: bool = False):
+			# The log urls are written before the checkpoint moves past the messages they belong to.
+			if rewrites:
+				done = rewrites.copy()
+				rewrites.clear()
+				await self.update_log(ctx.channel.id, done)
+			if last is not None:
+				await self.db.find_one_and_update(
+					{"_id": checkpoint_id}, {"$set": {"oldest": oldest, "last": last, "count": count}}, upsert=True
+				)
+			elapsed = time.monotonic() - started
+			rate = count_run / elapsed if elapsed else 0
+			text = f"{'Archived' if final else 'Archiving...'} **{count}** messages with attachments, {files} files ({rate:.1f} messages/s)."
+			if failures:
+				text += f"\n{failures} files failed and were queued to be retried."
+			if not final:
+				if limit:
+					eta = (limit - count_run) / rate if rate else None
+				else:
+					eta = history_eta(start, last, end, elapsed) if start and last else None
+				if eta is not None:
+					text += f"\nDone {discord.utils.format_dt(discord.utils.utcnow() + datetime.timedelta(seconds=eta), 'R')}."
+			await progress.edit(content=text)
+
+		progress = await ctx.send("Archiving...")
+		try:
+			async for msg in ctx.channel.history(limit=None, oldest_first=oldest, after=after, before=before):
+				if limit and count_run >= limit:
+					break
+				if start is None:
+					start = msg.id
+				if msg.attachments:
+					count += 1
+					count_run += 1
+					await slots.acquire()
+					pending.append((msg.id, asyncio.create_task(save(msg))))
+				else:
+					pending.append((msg.id, None))
+				advance()
+				if time.monotonic() - reported >= PROGRESS_INTERVAL:
+					reported = time.monotonic()
+					await report()
+			await asyncio.gather(*[task for _, task in pending if task])
+			advance()
+		finally:
+			for _, task in pending:
+				if task:
+					task.cancel()
+			await report(final=not pending)
+		await self.db.delete_one({"_id": checkpoint_id})
+		await self.bot.add_reaction(ctx.message, "✅")
+
+	def archive_channel_ids(self) -> set:
+		"""The IDs of the channels files are archived in."""
+		return {channel.id for channel in self.archive_channels} | {self.bot.log_channel.id}
+
+	async def stream_logs(self, after: Union[str, None]):
+		"""Go through the logs that have attachments in `_id` order, only fetching what backfill needs.
+
+		The cursor is reopened past the last log if it expires while backfill is busy.
+		:param after: Only logs after this `_id`.
+		"""
+		projection = {"channel_id": 1, "messages.message_id": 1, "messages.attachments": 1}
+		while True:
+			query = {"messages.attachments.0": {"$exists": True}}
+			if after is not None:
+				query["_id"] = {"$gt": after}
+			cursor = self.bot.db["logs"].find(query, projection).sort("_id", 1).batch_size(BACKFILL_BATCH)
+			try:
+				async for log in cursor:
+					after = log["_id"]
+					yield log
+				return
+			except CursorNotFound:
+				logger.debug(f"FileSave: Backfill cursor expired, reopening it after {after}.")
+
+	async def refresh_urls(
+		self, thread: int, messages: List[Tuple[int, List[JobAttachment]]]
+	) -> Tuple[List[Tuple[int, List[JobAttachment]]], int]:
+		"""Get freshly signed urls for attachments whose urls expired, and point the thread's log at them.
+
+		Discord's attachment urls expire about a day after they're signed, so those of old logs can't be downloaded as
+		they are. The log is updated first so the urls it ends up with match the ones archived or queued.
+		:param thread: The thread of the log.
+		:param messages: Tuples of a message ID and its attachments, as found by `log_attachments`.
+		:return: The messages with refreshed urls, without the attachments whose urls couldn't be, and how many those were.
+		"""
+		stale = list({att.url for _, attachments in messages for att in attachments if url_expired(att.url)})
+		fresh = {}
+		for pos in range(0, len(stale), REFRESH_BATCH):
+			try:
+				data = await self.bot.http.request(
+					http.Route("POST", "/attachments/refresh-urls"), json={"attachment_urls": stale[pos : pos + REFRESH_BATCH]}
+				)
+			except discord.HTTPException as e:
+				logger.warning(f"FileSave: Could not refresh attachment urls of {thread}: {e!r}")
+				self.failure(e)
+				continue
+			for entry in data.get("refreshed_urls") or []:
+				if entry.get("original") and not url_expired(entry.get("refreshed")):
+					fresh[entry["original"]] = entry["refreshed"]
+
+		if fresh:
+			try:
+				await self.update_log(
+					thread, [(att, fresh[att.url]) for _, attachments in messages for att in attachments if att.url in fresh]
+				)
+			except Exception as e:
+				logger.error(f"FileSave: Could not update the attachment urls of {thread}'s log: {e!r}")
+				self.failure(e)
+				fresh = {}
+
+		refreshed = []
+		skipped = 0
+		for message_id, attachments in messages:
+			kept = []
+			for att in attachments:
+				if att.url in fresh:
+					kept.append(att._replace(url=fresh[att.url]))
+				elif url_expired(att.url):
+					skipped += 1
+				else:
+					kept.append(att)
+			if kept:
+				refreshed.append((message_id, kept))
+		return refreshed, skipped
+
+	class BackfillFlags(commands.FlagConverter, case_insensitive=True, delimiter=" ", prefix="-"):
+		limit: Union[int, None] = commands.flag(name="limit", aliases=["lim"], description="Only this amount of logs")
+		fresh: Union[bool, None] = commands.flag(name="fresh", description="Start over instead of resuming")
+
+	@filesave.command(brief="Archive the files of past threads' logs.")
+	@checks.has_permissions(checks.PermissionLevel.ADMIN)
+	async def backfill(self, ctx: discord.ext.commands.Context, *, flags: BackfillFlags = None):
+		"""Goes through every log in the database and archives the attachments that never were, like ones from before
+		FileSave was installed or from threads that are already closed.
+		### Flags
+		Syntax: `-flagname argument`
+		- `limit`/`lim` - Only this amount of logs. Only accounts for ones with attachments to archive.
+		- `fresh` - Start over instead of resuming where the last run stopped.
+
+		Logs are read from the database a few at a time, and up to the `concurrency` setting are saved at once, with
+		attachments started at no more than the `backfill_rate` setting per minute. Uploads wait for those of open threads.
+		Progress is saved as it goes, so running the command again continues where an interrupted run stopped.
+		Attachment urls that expired are refreshed first, and attachments whose urls can't be are skipped. Attachments that
+		fail are queued to be retried later.
+		"""
+		if self.backfilling:
+			return await ctx.send("A backfill is already running.")
+		limit = flags.limit if flags and flags.limit else None
+		checkpoint_id = "backfill"
+		checkpoint = None if flags and flags.fresh else await self.db.find_one({"_id": checkpoint_id})
+		if checkpoint:
+			after = checkpoint["last"]
+			count = checkpoint["count"]
+			await ctx.send(f"Resuming from where the last run stopped ({count} logs with attachments were done).")
+		else:
+			if not await confirmation(
+				ctx, "This will post **every** attachment of every log that wasn't archived in your archive channel. Are you sure?"
+			):
+				return
+			after = None
+			count = 0
+
+		archived_in = self.archive_channel_ids()
+		rate = self.config["backfill_rate"]
+		bucket = RateWindow(rate, 60) if rate else None
+		scanned = 0
+		count_run = 0
+		files = 0
+		failures = 0
+		expired = 0
+		last = None
+		started = time.monotonic()
+		reported = started
+
+		slots = asyncio.Semaphore(max(self.config["concurrency"], 1))
+		pending = collections.deque()
+		rewrites = collections.defaultdict(list)
+
+		async def save(thread: int, messages: List[Tuple[int, List[JobAttachment]]]):
+			nonlocal files, failures, expired
+			try:
+				messages, skipped = await self.refresh_urls(thread, messages)
+				if skipped:
+					expired += skipped
+					self.metrics.inc("files_expired", value=skipped)
+				for message_id, attachments in messages:
+					if bucket:
+						for _ in attachments:
+							await bucket.acquire()
+					failed = await self.save_file(attachments, thread, BULK, rewrites[thread])
+					if failed:
+						failures += len(failed)
+						await self.enqueue(failed, thread, message_id, BULK)
+					files += len(attachments) - len(failed)
+					self.metrics.inc("files_backfilled", value=len(attachments) - len(failed))
+			finally:
+				slots.release()
+
+		def advance():
+			# The checkpoint can only move past logs whose saves, and every one before them, have finished.
+			nonlocal last
+			while pending and (pending[0][1] is None or pending[0][1].done()):
+				last = pending.popleft()[0]
+
+		async def report(final: bool = False):
+			# The log urls are written before the checkpoint moves past the logs they belong to.
+			# Saves still running hold on to their thread's list, so it's emptied rather than replaced.
+			for thread, urls in list(rewrites.items()):
+				if urls:
+					done = urls.copy()
+					urls.clear()
+					await self.update_log(thread, done)
+			if last is not None:
+				await self.db.find_one_and_update({"_id": checkpoint_id}, {"$set": {"last": last, "count": count}}, upsert=True)
+			elapsed = time.monotonic() - started
+			text = (
+				f"{'Backfilled' if final else 'Backfilling...'} **{count}** logs with attachments, {files} files "
+				f"({scanned} logs looked at, {count_run / elapsed if elapsed else 0:.1f} logs/s)."
+			)
+			if failures:
+				text += f"\n{failures} files failed and were queued to be retried."
+			if expired:
+				text += f"\n{expired} files were skipped, since their urls expired and couldn't be refreshed."
+			await progress.edit(content=text)
+
+		self.backfilling = True
+		progress = await ctx.send("Backfilling...")
+		try:
+			async for log in self.stream_logs(after):
+				if limit and count_run >= limit:
+					break
+				scanned += 1
+				if messages := log_attachments(log, archived_in):
+					count += 1
+					count_run += 1
+					await slots.acquire()
+					pending.append((log["_id"], asyncio.create_task(save(int(log["channel_id"]), messages))))
+				else:
+					pending.append((log["_id"], None))
+				advance()
+				if time.monotonic() - reported >= PROGRESS_INTERVAL:
+					reported = time.monotonic()
+					await report()
+			await asyncio.gather(*[task for _, task in pending if task])
+			advance()
+		finally:
+			self.backfilling = False
+			for _, task in pending:
+				if task:
+					task.cancel()
+			await report(final=not pending)
+		await self.db.delete_one({"_id": checkpoint_id})
 		await self.bot.add_reaction(ctx.message, "✅")
 
 
@@ -0,0 +1,125 @@
+"""Offline benchmark for how GForms splits long answers over embeds.
+
+Renders synthetic responses with multi-megabyte paragraph answers, both through `chunk_text` alone and through a full
+`GFormResponses.read`, and checks that every embed fits Discord's limit and that no code block is left open.
+
+Run it from the root of a Modmail checkout (so `bot` and `core` can be imported), e.g.:
+    python plugins/.../gforms/benchmark.py --size 4MB --responses 5
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import resource
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.getcwd())
+
+import gforms  # noqa: E402
+
+WORDS = ("lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing", "elit", "sed", "do", "eiusmod")
+
+
+def parse_size(text: str):
+	units = {"kb": 1024, "mb": 1024**2, "gb": 1024**3, "b": 1}
+	for unit, factor in units.items():
+		if text.lower().endswith(unit):
+			return int(float(text[: -len(unit)]) * factor)
+	return int(text)
+
+
+def paragraph(size: int, line_break: float, fences: float):
+	"""Make `size` characters of words, with line breaks and code blocks sprinkled in. Every code block is closed."""
+	parts = []
+	length = 0
+	fenced = False
+	while length < size - 4:
+		roll = random.random()
+		if roll < fences:
+			part = "\n```\n" if fenced or random.random() < 0.5 else "\n```py\n"
+			fenced = not fenced
+		elif roll < fences + line_break:
+			part = "\n"
+		else:
+			part = random.choice(WORDS) + " "
+		parts.append(part)
+		length += len(part)
+	if fenced:
+		parts.append("\n```")
+	return "".join(parts)
+
+
+def make_form():
+	return {
+		"formId": "benchmark",
+		"revisionId": "1",
+		"info": {"title": "Benchmark", "documentTitle": "Benchmark", "description": "A form with long answers."},
+		"items": [
+			{"title": "Short", "questionItem": {"question": {"questionId": "a", "textQuestion": {}}}},
+			{"title": "Long", "questionItem": {"question": {"questionId": "b", "textQuestion": {"paragraph": True}}}},
+		],
+	}
+
+
+def make_response(number: int, text: str):
+	return {
+		"responseId": f"response-{number}",
+		"lastSubmittedTime": "2024-01-01T00:00:00.123Z",
+		"answers": {"a": {"textAnswers": {"answers": [{"value": "short"}]}}, "b": {"textAnswers": {"answers": [{"value": text}]}}},
+	}
+
+
+def check(bodies: list):
+	"""Count the bodies that are too long and the ones with a code block left open."""
+	too_long = sum(len(body) > gforms.EMBED_LIMIT for body in bodies)
+	unbalanced = sum(body.count(gforms.FENCE) % 2 for body in bodies)
+	return too_long, unbalanced
+
+
+def report(name: str, size: int, times: list, bodies: list):
+	too_long, unbalanced = check(bodies)
+	print(f"{name}:")
+	print(f"  {len(times)} × {size / 1024**2:.1f} MB, mean {statistics.fmean(times):.3f}s, max {max(times):.3f}s", end="")
+	print(f" ({size / statistics.fmean(times) / 1024**2:.1f} MB/s)")
+	print(f"  {len(bodies)} embeds, {too_long} over {gforms.EMBED_LIMIT} characters, {unbalanced} with an open code block")
+
+
+async def main(args):
+	random.seed(args.seed)
+	size = parse_size(args.size)
+	texts = [paragraph(size, args.line_breaks, args.fences) for _ in range(args.responses)]
+
+	times = []
+	bodies = []
+	for text in texts:
+		started = time.perf_counter()
+		chunks = gforms.chunk_text(text)
+		times.append(time.perf_counter() - started)
+		bodies += chunks
+	report("chunk_text", size, times, bodies)
+
+	form = make_form()
+	times = []
+	bodies = []
+	for number, text in enumerate(texts):
+		started = time.perf_counter()
+		message = await gforms.GFormResponses(form, make_response(number, text)).read()
+		times.append(time.perf_counter() - started)
+		bodies += [embed.description for embed in message._embeds]
+	report("GFormResponses.read", size, times, bodies)
+
+	# ru_maxrss is in KB on Linux.
+	print(f"peak RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB")
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--size", default="4MB", help="size of each paragraph answer, e.g. 512KB or 8MB")
+	parser.add_argument("--responses", type=int, default=5, help="responses rendered")
+	parser.add_argument("--line-breaks", type=float, default=0.01, help="chance of a line break instead of a word")
+	parser.add_argument("--fences", type=float, default=0.0005, help="chance of a code fence instead of a word")
+	parser.add_argument("--seed", type=int, default=0)
+	asyncio.run(main(parser.parse_args()))
@@ -1,12 +1,16 @@
+import collections
 import datetime
+import heapq
+import itertools
 import json
 import os
 import re
-from typing import Union, Tuple
+from typing import Callable, Dict, List, NamedTuple, Union, Tuple
 
 import aiofiles
 import aiogoogle
 import aiogoogle.auth
+import asyncio
 import discord
 import jsonschema
 import motor.core
@@ -21,7 +25,20 @@ from core import paginator as pages, models
 # - Toggle whether questions with no answers are shown or not
 
 KEY_FILE = "service_account_key.json"
+DISCOVERY_FILE = "forms_discovery.json"
+# How old the cached discovery document can get before it's downloaded again, in hours.
+DISCOVERY_MAX_AGE = 24
 SCOPES = ["https://www.googleapis.com/auth/drive"]
+# How long a cached form is used before checking whether it changed, in seconds.
+FORM_TTL = 600
+# How many forms are cached at once.
+FORM_CACHE_SIZE = 64
+# How many watches can run at the same time.
+WATCH_CONCURRENCY = 4
+# How late a watch can start before it's logged as a warning, in seconds.
+LATE_WARNING = 60
+# How many IDs of responses sent at a watch's latest submit time are kept, to not send them again.
+MARK_IDS = 100
 
 key_schema = {
 	"type": "object",
@@ -120,6 +137,25 @@ async def get_time(time: str, now: datetime.datetime = None):
 	return when
 
 
+def submitted_at(response: dict) -> datetime.datetime:
+	"""Get when a response was last submitted, as an aware datetime."""
+	# Google gives up to nanoseconds, which datetime doesn't take.
+	stamp = re.sub(r"(\.\d{6})\d+", r"\1", response["lastSubmittedTime"]).replace("Z", "+00:00")
+	return datetime.datetime.fromisoformat(stamp)
+
+
+def watch_when(watch: dict) -> datetime.datetime:
+	"""Get when a watch is due, as an aware datetime."""
+	return watch["when"].replace(tzinfo=datetime.timezone.utc)
+
+
+async def next_when(watch: dict) -> datetime.datetime:
+	"""Get when a watch is due after its current run."""
+	if "hours" in watch:
+		return watch_when(watch) + datetime.timedelta(hours=watch["hours"])
+	return await get_time(watch["time"])
+
+
 async def is_set_up(ctx: commands.Context = None):
 	if not os.path.exists(KEY_FILE):
 		if ctx:
@@ -157,14 +193,12 @@ async def validate_channel(ctx: commands.Context, channel_id=None, check_permiss
 		return False
 
 
-async def send_response(
-	aiogoogle,
-	service: aiogoogle.resource.GoogleAPI,
-	form_id: str,
-	response: dict,
-	destination: Union[discord.abc.GuildChannel, commands.Context],
-):
-	form = await aiogoogle.as_service_account(service.forms.get(formId=form_id))
+async def send_response(form: dict, response: dict, destination: Union[discord.abc.GuildChannel, commands.Context]):
+	"""Send a response of a form.
+	:param form: The form, as given by `GForms.get_form`.
+	:param response: The response.
+	:param destination: Where to send it.
+	"""
 	message = await GFormResponses(form, response).read()
 	if isinstance(destination, commands.Context):
 		await message.send(ctx=destination)
@@ -182,9 +216,221 @@ def listsplit(num: int, li: Union[list, tuple]):
 	return results
 
 
+class FormCache:
+	"""Forms by ID, with when they were last known to be current. The least recently used ones are dropped past `size`."""
+
+	def __init__(self, size: int = FORM_CACHE_SIZE):
+		self.size = size
+		self.forms: collections.OrderedDict = collections.OrderedDict()
+
+	def get(self, form_id: str) -> Union[Tuple[dict, datetime.datetime], None]:
+		"""Get a cached form and when it was checked.
+		:return: (form, datetime), or None if it isn't cached.
+		"""
+		if form_id not in self.forms:
+			return None
+		self.forms.move_to_end(form_id)
+		return self.forms[form_id]
+
+	def put(self, form_id: str, form: dict):
+		self.forms[form_id] = (form, datetime.datetime.now(datetime.timezone.utc))
+		self.forms.move_to_end(form_id)
+		while len(self.forms) > self.size:
+			self.forms.popitem(last=False)
+
+	def pop(self, form_id: str):
+		self.forms.pop(form_id, None)
+
+
+# The most characters an embed's description can have.
+EMBED_LIMIT = 4096
+FENCE = "```"
+# The language of a code block, right after the fence that opens it.
+FENCE_LANGUAGE = re.compile(r"\w*(?=\n)")
+# The longest language carried over to a chunk that reopens a code block; longer ones are dropped.
+LANGUAGE_LIMIT = 32
+
+
+def chunk_text(text: str, size: int = EMBED_LIMIT, first: int = None) -> List[str]:
+	"""Split text into chunks of at most `size` characters, in a single pass over it.
+
+	A chunk ends after the last line break that fits, or else the last space, as long as that fills at least half of it.
+	Only text with neither is cut mid-word. A chunk that ends inside a code block closes it, and the next one opens it
+	again, with the same language.
+	:param text: The text to split.
+	:param size: The most characters a chunk can have.
+	:param first: The most characters the first chunk can have, if less than `size`. It's empty if nothing fits.
+	:return: list
+	"""
+	if size <= 2 * len(FENCE) + LANGUAGE_LIMIT + 2:
+		raise ValueError(f"Chunks must be longer than {2 * len(FENCE) + LANGUAGE_LIMIT + 2} characters.")
+	chunks = []
+	room = size if first is None else max(min(first, size), 0)
+	length = len(text)
+	pos = 0
+	# The fence that opened the code block the last chunk ended in.
+	opener = None
+	while pos < length:
+		prefix = f"{opener}\n" if opener else ""
+		if length - pos <= room - len(prefix):
+			chunks.append(prefix + text[pos:])
+			break
+		# Leaves room for closing a code block on a new line.
+		limit = room - len(prefix) - len(FENCE) - 1
+		if limit <= 0:
+			# Only the first chunk can be this short.
+			chunks.append("")
+			room = size
+			continue
+		end = pos + limit
+		cut = text.rfind("\n", pos + limit // 2, end)
+		if cut == -1:
+			cut = text.rfind(" ", pos + limit // 2, end)
+		if cut == -1:
+			cut = end
+			# Never split a fence, unless the run of backticks is half the chunk.
+			while cut > pos + limit // 2 + 1 and text[cut - 1] == "`" and text[cut] == "`":
+				cut -= 1
+			if text[cut - 1] == "`" and text[cut] == "`":
+				cut = end
+		else:
+			cut += 1
+		piece = text[pos:cut]
+		fences = piece.count(FENCE)
+		if (opener is not None) != (fences % 2 == 1):
+			if fences:
+				start = piece.rfind(FENCE) + len(FENCE)
+				language = FENCE_LANGUAGE.match(piece, start)
+				language = language[0] if language else ""
+				opener = FENCE + (language if len(language) <= LANGUAGE_LIMIT else "")
+			chunks.append(prefix + piece + (FENCE if piece.endswith("\n") else "\n" + FENCE))
+		else:
+			opener = None
+			chunks.append(prefix + piece)
+		pos = cut
+		room = size
+	return chunks or [""]
+
+
+# Runs of whitespace in grid row titles, which are shown on one line.
+GRID_SPACES = re.compile(r"\s{2,}")
+
+
+def scale_renderer(scale: dict):
+	"""Make the renderer of a linear scale question."""
+	low = scale.get("low")
+	high = scale.get("high")
+	low_label = scale.get("lowLabel")
+	high_label = scale.get("highLabel")
+	start = f"*{low_label}* — " if low_label is not None else ""
+	end = f" — *{high_label}*" if high_label is not None else ""
+
+	def render(answers: dict):
+		value = int(answers["textAnswers"]["answers"][0]["value"])
+		if low:
+			counter = "".join("𒊹" if i == value - 1 else "●" for i in range(high))
+		else:
+			counter = "".join("𒊹" if i == value else "●" for i in range(high + 1))
+		return "{} {} {} {} {}".format(start, low or "0", counter, high, end)
+
+	return render
+
+
+def question_renderer(question: dict):
+	"""Make the renderer of a question, which turns its answers into text, or None if they can't be shown."""
+	if scale := question.get("scaleQuestion"):
+		render_scale = scale_renderer(scale)
+	else:
+		render_scale = None
+	if "textQuestion" in question:
+		kind = "text"
+	elif "choiceQuestion" in question:
+		kind = "choice"
+		other = ["isOther" in option for option in question["choiceQuestion"]["options"]]
+	else:
+		kind = None
+
+	def render(answers: dict):
+		if "fileUploadAnswers" in answers:
+			return "\n".join(f'- https://drive.google.com/file/d/{a["fileId"]}/view' for a in answers["fileUploadAnswers"]["answers"])
+		elif "textAnswers" not in answers:
+			return None
+		elif render_scale:
+			return render_scale(answers)
+		elif kind == "text":
+			return f"```\n{answers['textAnswers']['answers'][0]['value']}```"
+		elif kind == "choice":
+			return "\n".join(f'- {"Other: " if other[i] else ""}{a["value"]}' for i, a in enumerate(answers["textAnswers"]["answers"]))
+		return "\n".join(f'- {a["value"]}' for a in answers["textAnswers"]["answers"])
+
+	return render
+
+
+def grid_renderer(group: dict):
+	"""Make the renderer of a grid, with a row for each of its questions."""
+	rows = [(q["questionId"], f"- **{GRID_SPACES.sub(' ', q['rowQuestion']['title'])}**\n") for q in group["questions"]]
+
+	def render(answers: dict):
+		return "\n".join(
+			title + "\n".join(f"  - {a['value']}" for a in answers[question_id]["textAnswers"]["answers"])
+			for question_id, title in rows
+			if question_id in answers
+		)
+
+	return render
+
+
+class RenderStep(NamedTuple):
+	"""How one item of a form is shown."""
+
+	ids: Tuple[str, ...]
+	title: str
+	description: str
+	render: Callable[[dict], Union[str, None]]
+	# Whether `render` takes all the answers, for a grid, instead of the answer to its one question.
+	is_group: bool
+
+
+class RenderPlan:
+	"""What a form's responses are shown as, worked out once per revision of the form instead of for every response."""
+
+	# Plans by form ID and revision, the least recently used dropped past `FORM_CACHE_SIZE`.
+	plans: collections.OrderedDict = collections.OrderedDict()
+
+	def __init__(self, form: dict):
+		self.steps: List[RenderStep] = []
+		for item in form.get("items", []):
+			if group := item.get("questionGroupItem"):
+				ids = tuple(q["questionId"] for q in group["questions"])
+				render = grid_renderer(group)
+				is_group = True
+			elif question := item.get("questionItem", {}).get("question"):
+				ids = (question["questionId"],)
+				render = question_renderer(question)
+				is_group = False
+			else:
+				continue
+			title = f'\n### {item.get("title", "*(empty)*")}\n'
+			self.steps.append(RenderStep(ids, title, item.get("description", "") + "\n", render, is_group))
+
+	@classmethod
+	def of(cls, form: dict) -> "RenderPlan":
+		"""Get the plan of a form, making it if this revision of the form doesn't have one yet."""
+		key = (form.get("formId"), form.get("revisionId"))
+		if key[1] is None:
+			return cls(form)
+		if key not in cls.plans:
+			cls.plans[key] = cls(form)
+			while len(cls.plans) > FORM_CACHE_SIZE:
+				cls.plans.popitem(last=False)
+		cls.plans.move_to_end(key)
+		return cls.plans[key]
+
+
 class GFormResponses:
 	def __init__(self, form: dict, response: dict):
 		self.form = form
+		self.plan = RenderPlan.of(form)
 		self.response = response
 		self.response_submit_time = datetime.datetime.strptime(
 			re.sub("\..+?(?=Z)", "", self.response["lastSubmittedTime"]), "%Y-%m-%dT%H:%M:%SZ"
@@ -201,150 +447,52 @@ class GFormResponses:
 
 		await self.split_embed(self.form["info"].get("description", ""))
 
-		for form_item in self.form["items"]:
-			try:
-				if form_item.get("questionGroupItem"):
-					question_ids = [i["questionId"] for i in form_item["questionGroupItem"]["questions"]]
-				else:
-					question_ids = [form_item["questionItem"]["question"]["questionId"]]
-			except KeyError:
-				continue
-			if answers := self.response.get("answers"):
-				self.answers = answers
-			else:
+		self.answers = self.response.get("answers")
+		for step in self.plan.steps:
+			if not self.answers:
 				self._embed.description = self._embed.description + "\n\n*This response has no answers.*"
 				break
-			await self.build_embed(form_item, question_ids)
+			await self.build_embed(step)
 		if self._embed not in self._embeds:
 			self._embeds.append(self._embed)
 		return self
 
-	async def build_embed(self, item, ids: list):
-		"""Generate embeds from a Google Form response."""
-		if self.answers:
-			if any([i in self.answers for i in ids]):
-				q_title = f'\n### {item.get(f"title", "*(empty)*")}\n'
-				q_desc = item.get(f"description", "") + "\n"
-
-				if group_item := item.get("questionGroupItem"):
-					reg = re.compile("\s{2,}")
-					q_answers = [
-						f"- **{re.sub(reg, ' ', q['rowQuestion']['title'])}**\n"
-						+ "\n".join([f"  - {a['value']}" for a in self.answers[q["questionId"]]["textAnswers"]["answers"]])
-						for q in group_item["questions"]
-						if q["questionId"] in self.answers
-					]
-
-				else:
-					question_id = item["questionItem"]["question"]["questionId"]
-					answers = self.answers[question_id]
-					if any(k in answers for k in ("fileUploadAnswers", "textAnswers")):
-						if "fileUploadAnswers" in answers:
-							q_answers = [
-								f'- https://drive.google.com/file/d/{a["fileId"]}/view' for a in answers["fileUploadAnswers"]["answers"]
-							]
-						elif scale := item["questionItem"]["question"].get("scaleQuestion"):
-							counter = ""
-
-							low = scale.get("low")
-							high = scale.get("high")
-
-							value = int(answers["textAnswers"]["answers"][0]["value"])
-
-							if low:
-								for i in range(high):
-									if i == value - 1:
-										counter += "𒊹"
-									else:
-										counter += "●"
-							else:
-								_high = high + 1
-								for i in range(_high):
-									if i == value:
-										counter += "𒊹"
-									else:
-										counter += "●"
-
-							low_label = scale.get("lowLabel")
-							high_label = scale.get("highLabel")
-							q_answers = "{} {} {} {} {}".format(
-								f"*{low_label}* — " if low_label is not None else "",
-								low or "0",
-								counter,
-								high,
-								f" — *{high_label}*" if high_label is not None else "",
-							)
-
-						else:
-							if "textQuestion" in item["questionItem"]["question"]:
-								q_answers = f"```\n{answers['textAnswers']['answers'][0]['value']}```"
-							elif "choiceQuestion" in item["questionItem"]["question"]:
-								q_answers = [
-									f'- {"Other: " if "isOther" in item["questionItem"]["question"]["choiceQuestion"]["options"][i] else ""}{a["value"]}'
-									for i, a in enumerate(answers["textAnswers"]["answers"]) or ""
-								]
-							else:
-								q_answers = [f'- {a["value"]}' for a in answers["textAnswers"]["answers"]]
-					else:
-						return
-
-				if isinstance(q_answers, list):
-					q_answers = "\n".join(q_answers)
-
-				if len(q_title) + len(self._embed.description) <= 4096:
-					self._embed.description = self._embed.description + q_title
-				else:
-					self._embeds.append(self._embed)
-					self._embed = Embed(description=q_title, timestamp=self.response_submit_time).set_footer(
-						text=f'Response ID {self.response["responseId"]}'
-					)
-
-				await self.split_embed(q_desc)
-
-				await self.split_embed(q_answers, string_type="textQuestion")
-
-	async def split_embed(self, string: str, string_type: str = None):
-		"""Split a form item over multiple embeds."""
-		length = len(string)
-		if 4096 < length + len(self._embed.description):
-			if 4096 < length:
-				pos = 0
-
-				while pos < length:
-					overflow = length + len(self._embed.description) - 4096
-
-					split_len = length - overflow
-
-					if string_type == "textQuestion":
-						split_len -= 7
-
-						string = re.sub("`(`+$|^`+)", "", string, flags=re.MULTILINE)
-
-						splitted = f"```\n{string[pos: pos + split_len]}```"
-
-					else:
-						splitted = string[pos : pos + split_len]
-
-					self._embed.description += splitted
-
-					pos += split_len
-
-					if not 4096 < len(self._embed.description):
-						if pos < length:
-							self._embeds.append(self._embed)
-							self._embed = Embed(description="", timestamp=self.response_submit_time).set_footer(
-								text=f'Response ID {self.response["responseId"]}'
-							)
-						else:
-							return
-			else:
-				self._embeds.append(self._embed)
-				self._embed = Embed(description=string, timestamp=self.response_submit_time).set_footer(
-					text=f'Response ID {self.response["responseId"]}'
-				)
+	async def build_embed(self, step: RenderStep):
+		"""Add an item of the form to the embeds, if the response answered it."""
+		if not any(i in self.answers for i in step.ids):
+			return
+		if step.is_group:
+			q_answers = step.render(self.answers)
+		else:
+			q_answers = step.render(self.answers[step.ids[0]])
+		if q_answers is None:
+			return
 
+		if len(step.title) + len(self._embed.description) <= EMBED_LIMIT:
+			self._embed.description = self._embed.description + step.title
 		else:
-			self._embed.description += string
+			self._embeds.append(self._embed)
+			self._embed = Embed(description=step.title, timestamp=self.response_submit_time).set_footer(
+				text=f'Response ID {self.response["responseId"]}'
+			)
+
+		await self.split_embed(step.description)
+
+		await self.split_embed(q_answers)
+
+	async def split_embed(self, string: str):
+		"""Add text to the embeds, continuing it over new ones where it doesn't fit."""
+		room = EMBED_LIMIT - len(self._embed.description)
+		if room < len(string) <= EMBED_LIMIT:
+			# Fits whole in a new embed, so it isn't split.
+			room = 0
+		chunks = chunk_text(string, first=room)
+		self._embed.description += chunks[0]
+		for chunk in chunks[1:]:
+			self._embeds.append(self._embed)
+			self._embed = Embed(description=chunk, timestamp=self.response_submit_time).set_footer(
+				text=f'Response ID {self.response["responseId"]}'
+			)
 
 	async def send(self, ctx: commands.Context = None, channel: discord.abc.GuildChannel = None):
 		"""Send a response of a Google Form to Discord."""
@@ -477,85 +625,320 @@ class GForms(commands.Cog):
 		self.bot: ModmailBot = bot
 		self.creds = None
 		self.db: motor.core.AgnosticCollection = bot.api.get_plugin_partition(self)
+		self.aiog: Union[aiogoogle.Aiogoogle, None] = None
+		self.service: Union[aiogoogle.resource.GoogleAPI, None] = None
+		self.forms = FormCache()
+		self.watches: Dict[object, dict] = {}
+		self.schedule: List[Tuple[datetime.datetime, int, object]] = []
+		self.order = itertools.count()
+		self.rescheduled = asyncio.Event()
+		self.running: Dict[object, asyncio.Task] = {}
+		self.lateness: Dict[object, float] = {}
+		self.slots = asyncio.Semaphore(WATCH_CONCURRENCY)
+		self.scheduler: Union[asyncio.Task, None] = None
+		# Held while the discovery document is downloaded and saved, which several watches can need at once.
+		self.discovery_lock = asyncio.Lock()
+
+	async def google(self) -> Tuple[aiogoogle.Aiogoogle, aiogoogle.resource.GoogleAPI]:
+		"""Get the Google client and the Forms API.
+
+		The client and its connections are kept for as long as the cog is loaded, and the API is built from the cached
+		discovery document, which is only downloaded when there isn't one yet.
+		:return: (Aiogoogle, GoogleAPI)
+		"""
+		if self.aiog is None:
+			self.aiog = aiogoogle.Aiogoogle(service_account_creds=self.creds)
+			await self.aiog.__aenter__()
+		if self.service is None:
+			await self.refresh_discovery(missing=True)
+		return self.aiog, self.service
+
+	async def get_form(self, form_id: str) -> dict:
+		"""Get a form, from the cache if it's there and hasn't changed.
+
+		A form cached for more than `FORM_TTL` seconds is checked by fetching only its revision ID, and is only fetched
+		again if that changed.
+		:param form_id: The ID of the form.
+		:return: The form.
+		"""
+		aiog, service = await self.google()
+		if cached := self.forms.get(form_id):
+			form, checked = cached
+			if (datetime.datetime.now(datetime.timezone.utc) - checked).total_seconds() < FORM_TTL:
+				return form
+			revision = await aiog.as_service_account(service.forms.get(formId=form_id, fields="revisionId"))
+			if revision.get("revisionId") == form.get("revisionId"):
+				self.forms.put(form_id, form)
+				return form
+		form = await aiog.as_service_account(service.forms.get(formId=form_id))
+		self.forms.put(form_id, form)
+		return form
+
+	async def close_google(self):
+		"""Close the Google client, so the next one uses the current credentials, and forget the forms the old ones got."""
+		self.forms = FormCache()
+		if self.aiog is not None:
+			aiog, self.aiog = self.aiog, None
+			await aiog.__aexit__(None, None, None)
+
+	async def load_discovery(self):
+		"""Build the Forms API from the discovery document saved on disk, if there is one."""
+		if os.path.exists(DISCOVERY_FILE):
+			try:
+				async with aiofiles.open(DISCOVERY_FILE, mode="r") as f:
+					self.service = aiogoogle.resource.GoogleAPI(json.loads(await f.read()))
+			except (OSError, ValueError) as e:
+				logger.warning(f"Could not load the cached discovery document: {e}")
+
+	async def refresh_discovery(self, missing: bool = False):
+		"""Download the Forms discovery document and save it to disk.
+		:param missing: Only if there's no Forms API yet. Another call may have got it while this one waited for its turn.
+		"""
+		async with self.discovery_lock:
+			if missing and self.service is not None:
+				return
+			if self.aiog is not None:
+				service = await self.aiog.discover("forms", "v1", disco_doc_ver=2)
+			else:
+				async with aiogoogle.Aiogoogle() as aiog:
+					service = await aiog.discover("forms", "v1", disco_doc_ver=2)
+			self.service = service
+			async with aiofiles.open(f"{DISCOVERY_FILE}.tmp", mode="w") as f:
+				await f.write(json.dumps(service.discovery_document))
+			os.replace(f"{DISCOVERY_FILE}.tmp", DISCOVERY_FILE)
+
+	@tasks.loop(hours=1)
+	async def discovery_refresh(self):
+		if self.service is not None and os.path.exists(DISCOVERY_FILE):
+			age = datetime.datetime.now().timestamp() - os.path.getmtime(DISCOVERY_FILE)
+			if age < DISCOVERY_MAX_AGE * 3600:
+				return
+		try:
+			await self.refresh_discovery()
+		except Exception as e:
+			logger.warning(f"Could not refresh the discovery document: {e}")
+
+	def add_watch(self, watch: dict):
+		"""Schedule a watch, or reschedule it if it changed."""
+		self.watches[watch["_id"]] = watch
+		heapq.heappush(self.schedule, (watch_when(watch), next(self.order), watch["_id"]))
+		self.rescheduled.set()
+
+	def remove_watch(self, watch_id):
+		# Its entry in the schedule is skipped once it comes up.
+		self.watches.pop(watch_id, None)
+		self.lateness.pop(watch_id, None)
+		self.rescheduled.set()
+
+	def start_scheduler(self):
+		if self.scheduler is None or self.scheduler.done():
+			self.scheduler = asyncio.create_task(self.run_scheduler())
+
+	def stop_scheduler(self):
+		if self.scheduler:
+			self.scheduler.cancel()
+		for task in self.running.values():
+			task.cancel()
+
+	async def run_scheduler(self):
+		"""Start watches as they come due, from a heap of when each one is next due.
+
+		The watches are read from the database once. Commands then update the heap directly, so there's no need to go
+		back to the database or restart anything when one changes. Entries left behind by a change are skipped.
+		"""
+		await self.bot.wait_until_ready()
+		self.watches.clear()
+		self.schedule.clear()
+		async for watch in self.db.find():
+			self.add_watch(watch)
+		while True:
+			while self.schedule and (
+				(watch := self.watches.get(self.schedule[0][2])) is None
+				or watch_when(watch) != self.schedule[0][0]
+				or self.schedule[0][2] in self.running
+			):
+				heapq.heappop(self.schedule)
+			self.rescheduled.clear()
+			if not self.schedule:
+				await self.rescheduled.wait()
+				continue
+			delay = (self.schedule[0][0] - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+			if delay > 0:
+				try:
+					await asyncio.wait_for(self.rescheduled.wait(), timeout=delay)
+				except asyncio.TimeoutError:
+					pass
+				continue
+			# Every watch that's due is taken at once, so watches of the same form share one run.
+			now = datetime.datetime.now(datetime.timezone.utc)
+			due = collections.defaultdict(list)
+			while self.schedule and self.schedule[0][0] <= now:
+				when, _, watch_id = heapq.heappop(self.schedule)
+				watch = self.watches.get(watch_id)
+				if watch is None or watch_when(watch) != when or watch_id in self.running:
+					continue
+				if watch not in due[watch["form_id"]]:
+					due[watch["form_id"]].append(watch)
+			for group in due.values():
+				task = asyncio.create_task(self.run_watches(group))
+				for watch in group:
+					self.running[watch["_id"]] = task
+
+	async def run_watches(self, group: List[dict]):
+		"""Run due watches of the same form, then schedule their next runs."""
+		try:
+			async with self.slots:
+				now = datetime.datetime.now(datetime.timezone.utc)
+				for task in group:
+					lateness = (now - watch_when(task)).total_seconds()
+					self.lateness[task["_id"]] = lateness
+					if lateness > LATE_WARNING:
+						logger.warning(f"The watch for {task['form_title']} in {task['channel_id']} started {lateness:.0f}s late.")
+					else:
+						logger.debug(f"The watch for {task['form_title']} in {task['channel_id']} started {lateness:.1f}s late.")
+				await self.check_watches(group)
+		except asyncio.CancelledError:
+			raise
+		except Exception as e:
+			logger.error(f"The watches for {group[0]['form_title']} ({len(group)}) failed: {e!r}")
+			# Tried again next time, still from the same point.
+			for task in group:
+				try:
+					await self.db.update_one({"_id": task["_id"]}, {"$set": {"when": await next_when(task)}})
+				except Exception as e:
+					logger.error(f"Could not reschedule the watch for {task['form_title']} in {task['channel_id']}: {e!r}")
+		finally:
+			for task in group:
+				self.running.pop(task["_id"], None)
+		# Its entry in the schedule is gone, so it never runs again if it isn't added back.
+		for task in group:
+			if task["_id"] not in self.watches:
+				continue
+			try:
+				watch = await self.db.find_one({"_id": task["_id"]})
+			except Exception as e:
+				logger.error(f"Could not reload the watch for {task['form_title']} in {task['channel_id']}: {e!r}")
+				self.add_watch({**task, "when": await next_when(task)})
+				continue
+			if watch:
+				self.add_watch(watch)
+			else:
+				self.remove_watch(task["_id"])
 
-	@tasks.loop()
-	async def form_watch(self):
-		task = None
-
-		query = self.db.find().sort([("when", 1)]).limit(1)
-
-		async for watch in query:
-			task = watch
-
-		if task is None:
-			return self.form_watch.cancel()
+	async def check_watches(self, group: List[dict]):
+		"""Send the responses a form got to every channel watching it, each since its watch last ran.
 
-		await discord.utils.sleep_until(task["when"].replace(tzinfo=datetime.timezone.utc))
-		since = task["since"].replace(tzinfo=datetime.timezone.utc)
+		The responses are listed once, from the earliest mark of the watches, and each one is rendered once, then sent
+		to the channels whose watch hasn't seen it yet.
 
-		async with aiogoogle.Aiogoogle(service_account_creds=self.creds) as aiog:
-			service = await aiog.discover("forms", "v1", disco_doc_ver=2)
-			_form = await aiog.as_service_account(service.forms.get(formId=task["form_id"]))
-			title = task["form_title"]
+		A watch's mark is the latest submit time of the responses it sent, along with the IDs of the ones sent at exactly
+		that time. It's saved after every response sent, in submit order, so a run that's cut off, or a clock that's off,
+		doesn't make the next run send responses twice or skip any. Watches from before marks start from their `since`.
+		"""
+		form_id = group[0]["form_id"]
+		title = group[0]["form_title"]
+		now = datetime.datetime.now(datetime.timezone.utc)
+		watches = []
+		for task in group:
 			if channel := self.bot.get_channel(task["channel_id"]):
-				now = datetime.datetime.now(datetime.timezone.utc)
-
-				nextpagetoken = None
-
 				if "hours" in task:
 					update = {"$set": {"since": now, "when": task["when"] + datetime.timedelta(hours=task["hours"])}}
 				else:
 					update = {"$set": {"since": now, "when": await get_time(task["time"])}}
-
-				while True:
-					if responses := await aiog.as_service_account(
-						service.forms.responses.list(
-							formId=task["form_id"],
-							filter=f"timestamp >= {since.isoformat().replace('+00:00', 'Z')}",
-							nextPageToken=nextpagetoken,
-						)
-					):
-						try:
-							if nextpagetoken is None:
-								content = f"**{title}**: Responses since {since.strftime('%B %d at %H:%M:%S')} :arrow_heading_down:"
-								if "pings" in task:
-									content = f'{",".join(task["pings"])}\n{content}'
-								await channel.send(content)
-								if "message_id" in task:
-									update["$unset"] = {"message_id": ""}
-							for response in responses["responses"]:
-								await send_response(aiog, service, task["form_id"], response, channel)
-							if "nextPageToken" in responses:
-								nextpagetoken = responses["nextPageToken"]
-							else:
-								break
-						except discord.Forbidden:
-							logger.warning(f"{channel.guild.name}: Could not send responses to {channel.name}.")
-							break
-					else:
-						content = f"**{title}**: No responses have been submitted since {since.strftime('%B %d at %H:%M:%S')}."
-						if "message_id" in task:
-							await channel.get_partial_message(task["message_id"]).edit(content=content)
-						else:
-							msg = await channel.send(content)
-							update["$set"]["message_id"] = msg.id
-						break
 				if "guild" not in task:
 					update["$set"]["guild"] = channel.guild.id
-				await self.db.update_one({"_id": task["_id"]}, update, upsert=False)
+				since = task["since"].replace(tzinfo=datetime.timezone.utc)
+				mark = task.get("mark")
+				# The channel, its watch, its mark, its update, and whether it can still be sent to.
+				watches.append(
+					{
+						"channel": channel,
+						"task": task,
+						"since": since,
+						"after": submitted_at({"lastSubmittedTime": mark["time"]}) if mark else since,
+						"mark": mark or {"time": None, "ids": []},
+						"update": update,
+						"sent": 0,
+						"ok": True,
+					}
+				)
 			else:
 				if "guild" in task:
 					logger.warning(f"{self.bot.get_guild(task['guild']).name}: A channel assigned to a watch ({task['channel_id']}) seems to no longer exist. The watch will be removed.")
 				else:
 					logger.warning(f"A channel assigned to a watch ({task['channel_id']}) seems to no longer exist. The watch will be removed.")
 				await self.db.delete_one({"_id": task["_id"]})
+				self.remove_watch(task["_id"])
+		if not watches:
+			return
 
-	@form_watch.before_loop
-	async def watch_before(self):
-		await self.bot.wait_until_ready()
+		aiog, service = await self.google()
+		form = await self.get_form(form_id)
+		since = min(watch["after"] for watch in watches).replace(microsecond=0)
+		found = []
+		nextpagetoken = None
+		while True:
+			responses = await aiog.as_service_account(
+				service.forms.responses.list(
+					formId=form_id,
+					filter=f"timestamp >= {since.isoformat().replace('+00:00', 'Z')}",
+					nextPageToken=nextpagetoken,
+				)
+			)
+			found += (responses or {}).get("responses", [])
+			if responses and "nextPageToken" in responses:
+				nextpagetoken = responses["nextPageToken"]
+			else:
+				break
+
+		# Listed in no particular order, but the marks only work if they're sent oldest first.
+		for submitted, response in sorted(((submitted_at(r), r) for r in found), key=lambda pair: pair[0]):
+			message = None
+			for watch in watches:
+				if not watch["ok"] or submitted < watch["after"]:
+					continue
+				if submitted == watch["after"] and response["responseId"] in watch["mark"]["ids"]:
+					continue
+				channel = watch["channel"]
+				task = watch["task"]
+				try:
+					if not watch["sent"]:
+						content = f"**{title}**: Responses since {watch['since'].strftime('%B %d at %H:%M:%S')} :arrow_heading_down:"
+						if "pings" in task:
+							content = f'{",".join(task["pings"])}\n{content}'
+						await channel.send(content)
+						if "message_id" in task:
+							watch["update"]["$unset"] = {"message_id": ""}
+					if message is None:
+						message = await GFormResponses(form, response).read()
+					await message.send(channel=channel)
+					watch["sent"] += 1
+					if submitted == watch["after"]:
+						watch["mark"]["ids"] = (watch["mark"]["ids"] + [response["responseId"]])[-MARK_IDS:]
+					else:
+						watch["after"] = submitted
+						watch["mark"]["ids"] = [response["responseId"]]
+					watch["mark"]["time"] = response["lastSubmittedTime"]
+					await self.db.update_one({"_id": task["_id"]}, {"$set": {"mark": watch["mark"]}})
+				except discord.Forbidden:
+					logger.warning(f"{channel.guild.name}: Could not send responses to {channel.name}.")
+					watch["ok"] = False
+
+		for watch in watches:
+			task = watch["task"]
+			if watch["ok"] and not watch["sent"]:
+				content = f"**{title}**: No responses have been submitted since {watch['since'].strftime('%B %d at %H:%M:%S')}."
+				if "message_id" in task:
+					await watch["channel"].get_partial_message(task["message_id"]).edit(content=content)
+				else:
+					msg = await watch["channel"].send(content)
+					watch["update"]["$set"]["message_id"] = msg.id
+			await self.db.update_one({"_id": task["_id"]}, watch["update"], upsert=False)
 
 	async def cog_load(self):
-		self.form_watch.start()
+		await self.load_discovery()
+		self.discovery_refresh.start()
+		self.start_scheduler()
 		if await is_set_up():
 			logger.line()
 			credentials = json.load(open(KEY_FILE))
@@ -564,6 +947,11 @@ class GForms(commands.Cog):
 			logger.info("Loaded credentials.")
 			logger.line()
 
+	async def cog_unload(self):
+		self.stop_scheduler()
+		self.discovery_refresh.cancel()
+		await self.close_google()
+
 	@commands.group(name="gforms")
 	@checks.has_permissions(checks.PermissionLevel.ADMIN)
 	async def gforms(self, ctx):
@@ -609,9 +997,9 @@ class GForms(commands.Cog):
 
 					del json["universe_domain"]
 					self.creds = aiogoogle.auth.creds.ServiceAccountCreds(scopes=SCOPES, **json)
+					await self.close_google()
 
-					if not self.form_watch.is_running():
-						self.form_watch.start()
+					self.start_scheduler()
 
 					await self.bot.add_reaction(ctx.message, "✅")
 
@@ -716,49 +1104,46 @@ class GForms(commands.Cog):
 
 				when = await get_time(time, now)
 
-				async with aiogoogle.Aiogoogle(service_account_creds=self.creds) as aiog:
-					service = await aiog.discover("forms", "v1", disco_doc_ver=2)
-					form = await aiog.as_service_account(service.forms.get(formId=form_id))
-					if watch := await self.db.find_one({"channel_id": channel.id, "form_id": form_id}):
-						params = {"$set": {"hours": flags.hours, "when": when}}
-						if flags and flags.ping:
-							# I hate flags sometimes
-							pings = []
-							ping = ""
-							for char in flags.ping:
-								if char != "":
-									ping = ping + char
-								else:
-									pings.append(ping)
-									ping = ""
-							params["$set"]["pings"] = pings
-						if "time" in watch:
-							params["$unset"] = {"time": ""}
-						if "guild" not in watch:
-							params["$set"]["guild"] = ctx.guild.id
+				form = await self.get_form(form_id)
+				if watch := await self.db.find_one({"channel_id": channel.id, "form_id": form_id}):
+					params = {"$set": {"hours": flags.hours, "when": when}}
+					if flags and flags.ping:
+						# I hate flags sometimes
+						pings = []
+						ping = ""
+						for char in flags.ping:
+							if char != "":
+								ping = ping + char
+							else:
+								pings.append(ping)
+								ping = ""
+						params["$set"]["pings"] = pings
+					if "time" in watch:
+						params["$unset"] = {"time": ""}
+					if "guild" not in watch:
+						params["$set"]["guild"] = ctx.guild.id
 
-						await self.db.update_one({"_id": watch["_id"]}, params)
+					await self.db.update_one({"_id": watch["_id"]}, params)
+					self.add_watch(await self.db.find_one({"_id": watch["_id"]}))
 
-					else:
-						params = {
-							"guild": ctx.guild.id,
-							"form_title": form["info"].get("title", form["info"]["documentTitle"]),
-							"form_id": form_id,
-							"channel_id": channel.id,
-							"hours": flags.hours,
-							"since": now,
-							"when": when,
-						}
-						if flags and flags.ping:
-							params["pings"] = [mentionable.mention for mentionable in flags.ping]
-						await self.db.insert_one(params)
-
-					if self.form_watch.is_running():
-						self.form_watch.restart()
-					else:
-						self.form_watch.start()
+				else:
+					params = {
+						"guild": ctx.guild.id,
+						"form_title": form["info"].get("title", form["info"]["documentTitle"]),
+						"form_id": form_id,
+						"channel_id": channel.id,
+						"hours": flags.hours,
+						"since": now,
+						"when": when,
+					}
+					if flags and flags.ping:
+						params["pings"] = [mentionable.mention for mentionable in flags.ping]
+					await self.db.insert_one(params)
+					self.add_watch(params)
+
+				self.start_scheduler()
 
-					await self.bot.add_reaction(ctx.message, "✅")
+				await self.bot.add_reaction(ctx.message, "✅")
 
 	@gforms.command(brief="Remove a form watch.", usage="<form id> <channel id>")
 	@checks.has_permissions(checks.PermissionLevel.ADMIN)
@@ -773,10 +1158,8 @@ class GForms(commands.Cog):
 				channel = ctx.channel.id
 
 			if channel:
-				result = await self.db.delete_one({"channel_id": channel, "form_id": form_id})
-				if result.deleted_count > 0:
-					if self.form_watch.is_running():
-						self.form_watch.restart()
+				if watch := await self.db.find_one_and_delete({"channel_id": channel, "form_id": form_id}):
+					self.remove_watch(watch["_id"])
 					return await self.bot.add_reaction(ctx.message, "✅")
 				else:
 					return await ctx.send("No watch for that form in that channel.")
@@ -786,7 +1169,7 @@ class GForms(commands.Cog):
 	async def watches(self, ctx: commands.Context):
 		"""List all the form watches for the server."""
 		if await is_set_up(ctx):
-			watches = await self.db.find({"guild": ctx.guild.id}, {"_id": False}).to_list(None)
+			watches = await self.db.find({"guild": ctx.guild.id}).to_list(None)
 			embeds = []
 			if watches:
 				for li in listsplit(5, watches):
@@ -795,6 +1178,7 @@ class GForms(commands.Cog):
 							[
 								f"- **Form**: {watch['form_title']} (`{watch['form_id']}`)\n - **Channel**: <#{watch['channel_id']}>"
 								f" (`{watch['channel_id']}`)\n - **Next run**: {watch['when']}"
+								+ (f"\n - **Last run**: {self.lateness[watch['_id']]:.0f}s late" if watch["_id"] in self.lateness else "")
 								for watch in li
 							]
 						)
@@ -816,6 +1200,9 @@ class GForms(commands.Cog):
 			):
 				os.remove(KEY_FILE)
 				self.db.drop()
+				for watch_id in list(self.watches):
+					self.remove_watch(watch_id)
+				await self.close_google()
 				await self.bot.add_reaction(ctx.message, "✅")
 			else:
 				await self.bot.add_reaction(ctx.message, "❎")
@@ -839,37 +1226,37 @@ class GForms(commands.Cog):
 
 			response_count = 0
 
-			async with aiogoogle.Aiogoogle(service_account_creds=self.creds) as aiog:
-				service = await aiog.discover("forms", "v1", disco_doc_ver=2)
-				while True:
-					if responses := await aiog.as_service_account(
-						service.forms.responses.list(
-							formId=form_id,
-							pageSize=flags.limit if flags else None,
-							filter=f"timestamp >= {flags.time}" if flags and flags.time else None,
-							nextPageToken=nextpagetoken,
-						)
-					):
-						for i, response in enumerate(responses["responses"], start=1):
-							if flags:
-								if flags.number:
-									response_count += len(responses["responses"])
-									if response_count >= flags.number:
-										return await send_response(aiog, service, form_id, responses["responses"][flags.number - 1], ctx)
-									else:
-										break
-							await send_response(aiog, service, form_id, response, ctx)
-
-						if "nextPageToken" in responses:
-							nextpagetoken = responses["nextPageToken"]
-						else:
-							break
-					else:
+			aiog, service = await self.google()
+			form = await self.get_form(form_id)
+			while True:
+				if responses := await aiog.as_service_account(
+					service.forms.responses.list(
+						formId=form_id,
+						pageSize=flags.limit if flags else None,
+						filter=f"timestamp >= {flags.time}" if flags and flags.time else None,
+						nextPageToken=nextpagetoken,
+					)
+				):
+					for i, response in enumerate(responses["responses"], start=1):
 						if flags:
-							if flags.time:
-								return await ctx.send("No responses since that date.")
-							else:
-								return await ctx.send("No responses.")
+							if flags.number:
+								response_count += len(responses["responses"])
+								if response_count >= flags.number:
+									return await send_response(form, responses["responses"][flags.number - 1], ctx)
+								else:
+									break
+						await send_response(form, response, ctx)
+
+					if "nextPageToken" in responses:
+						nextpagetoken = responses["nextPageToken"]
+					else:
+						break
+				else:
+					if flags:
+						if flags.time:
+							return await ctx.send("No responses since that date.")
+						else:
+							return await ctx.send("No responses.")
 
 			if flags:
 				if flags.number:
@@ -892,10 +1279,10 @@ class GForms(commands.Cog):
 						"The service account seems to be invalid... The stored json will be deleted. Use `?gforms setup` and use a key for"
 						" a new acccount."
 					)
-					if self.form_watch.is_running():
-						self.form_watch.cancel()
+					self.stop_scheduler()
 					os.remove(KEY_FILE)
 					self.creds = None
+					await self.close_google()
 				elif "The caller does not have permission" in error.original.res.reason:
 					await ctx.send(
 						"The provided service account does not have access to this form or the permissions needed...\nYou can show the"